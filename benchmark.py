@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import nsw_property_sales as nsw
+
+STREETS = (
+    "GEORGE ST",
+    "PACIFIC HWY",
+    "OXFORD ST",
+    "PARRAMATTA RD",
+    "VICTORIA RD",
+    "KING ST",
+    "CHURCH ST",
+    "MILITARY RD",
+    "BOTANY RD",
+    "THE BOULEVARDE",
+)
+LOCALITIES = (
+    "PADDINGTON",
+    "SURRY HILLS",
+    "NEWTOWN",
+    "BONDI",
+    "PARRAMATTA",
+    "CHATSWOOD",
+    "MANLY",
+    "PENRITH",
+    "WOLLONGONG",
+    "NEWCASTLE",
+)
+PURPOSES = ("RESIDENCE", "VACANT LAND", "FLATS", "COMMERCIAL", "FARMING")
+ZONES = ("R1", "R2", "R3", "B4", "RU1", "IN1", "A", "E4")
+
+
+def _sale_fields(rng, day):
+    contract = day - timedelta(days=rng.randint(20, 90))
+    return {
+        "property_id": str(rng.randint(1, 4_000_000)),
+        "unit": rng.choice(("", "", "", str(rng.randint(1, 40)))),
+        "house": str(rng.randint(1, 400)),
+        "street": rng.choice(STREETS),
+        "locality": rng.choice(LOCALITIES),
+        "post_code": str(rng.randint(2000, 2999)),
+        "area": f"{rng.uniform(80, 5000):.1f}",
+        "area_type": rng.choice("MMMH"),
+        "contract": contract,
+        "price": str(rng.randint(150_000, 4_000_000)),
+        "zone": rng.choice(ZONES),
+    }
+
+
+def sales_data_file(rng, district, day, sales):
+    # Current format: A header, then per sale a B record followed by C
+    # (description, possibly split over several lines) and D (purchaser and
+    # vendor) records, padding lines and a Z footer with the record counts.
+    stamp = f"{day:%Y%m%d} 01:{rng.randint(10, 59)}:{rng.randint(10, 59)}"
+    lines = [f"A;RTSALEDATA;{district};{stamp};VALNET;"]
+    counts = {"B": 0, "C": 0, "D": 0}
+    for counter in range(sales):
+        f = _sale_fields(rng, day)
+        key = f"{district};{f['property_id']};{counter};{stamp}"
+        lines.append(
+            f"B;{key};;{f['unit']};{f['house']};{f['street']};{f['locality']};"
+            f"{f['post_code']};{f['area']};{f['area_type']};"
+            f"{f['contract']:%Y%m%d};{day:%Y%m%d};{f['price']};{f['zone']};"
+            f"{rng.choice('VR3')};{rng.choice(PURPOSES)};;R;;;"
+            f"AS{rng.randint(100000, 999999)};"
+        )
+        counts["B"] += 1
+        for part in range(rng.choice((1, 1, 2, 3))):
+            lines.append(f"C;{key};LOT {rng.randint(1, 99)} DP{part}{counter} ;")
+            counts["C"] += 1
+        for party in rng.choice(("PV", "PPV", "PVV")):
+            lines.append(f"D;{key};{party};;;;;;;")
+            counts["D"] += 1
+        if rng.random() < 0.01:
+            lines.append(";;;;")
+    total = sum(counts.values()) + 2
+    lines.append(f"Z;{total};{counts['B']};{counts['C']};{counts['D']}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def archive_sales_file(rng, district, year, sales):
+    # 1990-2000 format: a flat B record per sale, dates as DD/MM/YYYY.
+    lines = [f"A;{district};SALES;{year}0101 00:00;VALNET"]
+    for counter in range(sales):
+        f = _sale_fields(rng, date(year, 12, 31))
+        lines.append(
+            f"B;{district};S;{counter};{f['property_id']};{f['unit']};"
+            f"{f['house']};{f['street']};{f['locality']};{f['post_code']};"
+            f"{f['contract']:%d/%m/%Y};{f['price']};LOT {counter} DP{year};"
+            f"{f['area']};{f['area_type']};20 X 40;R;{f['zone']};"
+        )
+    lines.append(f"Z;{sales + 2};{sales}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def zip_bytes(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, data in members:
+            zip_ref.writestr(name, data)
+    return buffer.getvalue()
+
+
+def weekly_zip(rng, day, districts, sales):
+    return zip_bytes(
+        (f"{district}_SALES_DATA_NNME_{day:%Y%m%d}.DAT", sales_data_file(rng, district, day, sales))
+        for district in districts
+    )
+
+
+def generate_site(site_path, years=2, weeks=4, districts=4, sales=250, seed=0):
+    # Mimics the Valuer General's listing: an archive of 1990s files, yearly
+    # zips of weekly zips and loose weekly zips for the current year, plus a
+    # PDF, all linked from index.html.
+    rng = random.Random(seed)
+    site_path = Path(site_path)
+    site_path.mkdir(parents=True, exist_ok=True)
+    codes = sorted(nsw.CODE_TO_DISTRICT)[:districts]
+    links = []
+
+    archive = zip_bytes(
+        (f"ARCHIVE_SALES_{year}.DAT", archive_sales_file(rng, code, year, sales * weeks))
+        for year in range(1990, 1990 + years)
+        for code in codes[:1]
+    )
+    (site_path / "ARCHIVE_SALES_1990-2000.zip").write_bytes(archive)
+    links.append("ARCHIVE_SALES_1990-2000.zip")
+
+    first_year = 2024 - years
+    for year in range(first_year, first_year + years):
+        days = [date(year, 1, 7) + timedelta(weeks=week) for week in range(weeks)]
+        yearly = zip_bytes(
+            (f"{day:%Y%m%d}.zip", weekly_zip(rng, day, codes, sales)) for day in days
+        )
+        (site_path / f"{year}.zip").write_bytes(yearly)
+        links.append(f"{year}.zip")
+    for week in range(weeks):
+        day = date(2024, 1, 7) + timedelta(weeks=week)
+        (site_path / f"{day:%Y%m%d}.zip").write_bytes(weekly_zip(rng, day, codes, sales))
+        links.append(f"{day:%Y%m%d}.zip")
+
+    (site_path / "Property_Sales_Data_File_Format.pdf").write_bytes(b"%PDF-1.4\n")
+    links.append("Property_Sales_Data_File_Format.pdf")
+    html = "".join(f'<a href="{link}">{link}</a>\n' for link in links)
+    (site_path / "index.html").write_text(f"<html><body>\n{html}</body></html>\n")
+    return site_path
+
+
+@contextlib.contextmanager
+def serve(site_path):
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    handler = functools.partial(QuietHandler, directory=str(site_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/index.html"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def timed(fn, *args, **kwargs):
+    nsw.MANIFEST.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def result(seconds, nbytes=None, records=None, files=None):
+    out = {"seconds": round(seconds, 4)}
+    if nbytes is not None:
+        out["bytes"] = nbytes
+        out["mb_per_s"] = round(nbytes / 2**20 / seconds, 3)
+    if records is not None:
+        out["records"] = records
+        out["records_per_s"] = round(records / seconds, 1)
+    if files is not None:
+        out["files"] = files
+    return out
+
+
+def csv_rows(csv_path):
+    with open(csv_path, "rb") as f:
+        return sum(1 for _ in f) - 1
+
+
+# The dict building parsers nsw_property_sales started with, kept as they
+# were apart from the pinned encoding. They share no code with the mmap
+# parser, so the suite can check the rewrite row for row against them.
+def original_parse_1990_file(file_path):
+    data = {"HEADER": None, "SALES": [], "FOOTER": None}
+    with open(file_path, "r", encoding=nsw.DAT_ENCODING) as file:
+        for line in file:
+            parts = line.strip().split(";")
+            record_type = parts[0]
+            if record_type == "A":
+                data["HEADER"] = {
+                    "record_type": parts[0],
+                    "district_code": parts[1],
+                    "source": parts[2],
+                    "download_datetime": parts[3],
+                    "submitter_user_id": parts[4],
+                }
+            elif record_type == "B":
+                area_type = {"M": "Square Meters", "H": "Hectares"}.get(
+                    parts[14], parts[14]
+                )
+                contract_date = "".join(parts[10].split("/")[::-1])
+                data["SALES"].append(
+                    {
+                        "district_code": parts[1],
+                        "district_name": nsw.CODE_TO_DISTRICT.get(parts[1].strip(), ""),
+                        "property_id": parts[4],
+                        "file_datetime": data["HEADER"]["download_datetime"],
+                        "property_name": "",
+                        "property_unit_number": parts[5],
+                        "property_house_number": parts[6],
+                        "property_street_name": parts[7],
+                        "property_locality": parts[8],
+                        "property_post_code": parts[9],
+                        "area": parts[13],
+                        "area_type": area_type,
+                        "contract_date": contract_date,
+                        "settlement_date": contract_date,
+                        "purchase_price": parts[11],
+                        "zone_code": parts[17],
+                        "zone_name": nsw.CODE_TO_ZONE.get(parts[17].strip(), ""),
+                        "nature_property": "",
+                        "primary_purpose": "",
+                        "strata_number": "",
+                        "component_code": parts[16],
+                        "sale_code": "",
+                        "interest_sale": "",
+                        "dealing_number": "",
+                        "property_description": parts[12],
+                        "purchaser_vendor": "",
+                        "dimensions": parts[15],
+                        "filetype": "archive",
+                    }
+                )
+            elif record_type == "Z":
+                data["FOOTER"] = {
+                    "record_type": parts[0],
+                    "total_records": parts[1],
+                    "total_B_records": parts[2],
+                }
+    return data
+
+
+def _join_lists(sale):
+    if isinstance(sale["property_description"], list):
+        sale["property_description"] = "".join(sale["property_description"])
+    if isinstance(sale["purchaser_vendor"], list):
+        sale["purchaser_vendor"] = ", ".join(sale["purchaser_vendor"])
+
+
+def original_parse_sales_data_file(file_path):
+    data = {"HEADER": None, "FOOTER": None, "SALES": []}
+    sales_index = {}
+    with open(file_path, "r", encoding=nsw.DAT_ENCODING) as file:
+        for line in file:
+            line = line.strip()
+            if line == "" or set(line) == {";"}:
+                continue
+            parts = line.split(";")
+            record_type = parts[0]
+            key = tuple(parts[1:5])
+            if record_type == "A":
+                if len(parts) == 5:
+                    parts = [parts[0]] + ["NA"] + parts[1:]
+                if len(parts) != 6:
+                    raise ValueError("Invalid File Header:", line)
+                data["HEADER"] = {
+                    "file_type": parts[1],
+                    "district_code": parts[2],
+                    "download_datetime": parts[3],
+                    "submitter_user_id": parts[4],
+                }
+            elif record_type == "Z":
+                data["FOOTER"] = {
+                    "total_records": parts[1],
+                    "total_B_records": parts[2],
+                    "total_C_records": parts[3],
+                    "total_D_records": parts[4],
+                }
+            elif record_type == "B":
+                if data["SALES"]:
+                    _join_lists(data["SALES"][-1])
+                area_type = {"M": "Square Meters", "H": "Hectares"}.get(
+                    parts[12], parts[12]
+                )
+                nature_property = {"V": "Vacant", "R": "Residence", "3": "Other"}.get(
+                    parts[17], parts[17]
+                )
+                sales_index[key] = {
+                    "district_code": parts[1],
+                    "district_name": nsw.CODE_TO_DISTRICT.get(parts[1].strip(), ""),
+                    "property_id": parts[2],
+                    "file_datetime": parts[4],
+                    "property_name": parts[5],
+                    "property_unit_number": parts[6],
+                    "property_house_number": parts[7],
+                    "property_street_name": parts[8],
+                    "property_locality": parts[9],
+                    "property_post_code": parts[10],
+                    "area": parts[11],
+                    "area_type": area_type,
+                    "contract_date": parts[13],
+                    "settlement_date": parts[14],
+                    "purchase_price": parts[15],
+                    "zone_code": parts[16],
+                    "zone_name": nsw.CODE_TO_ZONE.get(parts[16].strip(), ""),
+                    "nature_property": nature_property,
+                    "primary_purpose": parts[18],
+                    "strata_number": parts[19],
+                    "component_code": parts[20],
+                    "sale_code": parts[21],
+                    "interest_sale": parts[22],
+                    "dealing_number": parts[23],
+                    "property_description": [],
+                    "purchaser_vendor": [],
+                    "dimensions": "",
+                    "filetype": "sales",
+                }
+                data["SALES"].append(sales_index[key])
+            elif record_type == "C" and key in sales_index:
+                sales_index[key]["property_description"].append(parts[5])
+            elif record_type == "D" and key in sales_index:
+                purchaser_vendor = {"P": "Purchaser", "V": "Vendor"}.get(
+                    parts[5], parts[5]
+                )
+                sales_index[key]["purchaser_vendor"].append(purchaser_vendor)
+    if data["SALES"]:
+        _join_lists(data["SALES"][-1])
+    return data
+
+
+def bench_suite(work, years, weeks, districts, sales, repeat):
+    site = generate_site(work / "site", years, weeks, districts, sales)
+    results = {}
+
+    def best(name, run):
+        runs = [run() for _ in range(repeat)]
+        results[name] = min(runs, key=lambda r: r["seconds"])
+        print(f"{name:<28}" + "  ".join(f"{k}={v}" for k, v in results[name].items()))
+
+    # Single files for the parsers, as big as a busy week in a large district.
+    rng = random.Random(1)
+    sales_dat = work / "001_SALES_DATA_NNME_20240107.DAT"
+    sales_dat.write_bytes(sales_data_file(rng, "001", date(2024, 1, 7), sales * 20))
+    archive_dat = work / "ARCHIVE_SALES_1995.DAT"
+    archive_dat.write_bytes(archive_sales_file(rng, "001", 1995, sales * 20))
+
+    def parse(parser, path):
+        data, seconds = timed(parser, path)
+        return result(seconds, path.stat().st_size, len(data["SALES"]))
+
+    best("parse_sales_data_file", lambda: parse(nsw.parse_sales_data_file, sales_dat))
+    best("parse_1990_file", lambda: parse(nsw.parse_1990_file, archive_dat))
+
+    # The original parsers against the mmap one that the conversion uses,
+    # which must agree row for row, also with CRLF line endings and with
+    # chunks small enough to cut through every few lines.
+    def original_rows(path, parser):
+        return [tuple(sale[c] for c in nsw.COLUMNS) for sale in parser(path)["SALES"]]
+
+    def mmap_rows(path, record_format, chunk_size=1 << 20):
+        with nsw.open_dat_buffer(path) as buffer:
+            return list(nsw.iter_sale_records(buffer, record_format, None, None, chunk_size))
+
+    def scan(rows, path, *args):
+        data, seconds = timed(rows, path, *args)
+        return result(seconds, path.stat().st_size, len(data))
+
+    for label, path, parser, record_format in (
+        ("sales_data", sales_dat, original_parse_sales_data_file, nsw.SALES_DATA_FORMAT),
+        ("1990", archive_dat, original_parse_1990_file, nsw.ARCHIVE_FORMAT),
+    ):
+        crlf_path = path.with_name(f"crlf_{path.name}")
+        crlf_path.write_bytes(path.read_bytes().replace(b"\n", b"\r\n"))
+        expected = original_rows(path, parser)
+        for check_path, chunk_size in ((path, 1 << 20), (path, 97), (crlf_path, 97)):
+            if mmap_rows(check_path, record_format, chunk_size) != expected:
+                raise AssertionError(
+                    f"mmap parser disagrees with the original on {check_path.name} "
+                    f"in {chunk_size} byte chunks"
+                )
+        best(f"original_parser_{label}", lambda: scan(original_rows, path, parser))
+        best(f"mmap_parser_{label}", lambda: scan(mmap_rows, path, record_format))
+
+    archives = sorted(site.glob("*.zip"))
+    archive_bytes = sum(path.stat().st_size for path in archives)
+
+    def extract():
+        downloads, extracted = work / "downloads", work / "extracted"
+        shutil.rmtree(downloads, ignore_errors=True)
+        shutil.rmtree(extracted, ignore_errors=True)
+        downloads.mkdir()
+        extracted.mkdir()
+        for path in archives:
+            shutil.copy(path, downloads)
+        _, seconds = timed(nsw.process_downloaded_files, downloads, extracted)
+        return result(seconds, archive_bytes, files=len(list(extracted.glob("*.DAT"))))
+
+    best("process_downloaded_files", extract)
+    extracted = work / "extracted"
+    dat_bytes = sum(path.stat().st_size for path in extracted.glob("*.DAT"))
+
+    def convert(**options):
+        out = work / "land_value.csv"
+        _, seconds = timed(nsw.data_to_csv, extracted, out, **options)
+        return result(seconds, dat_bytes, csv_rows(out))
+
+    best("data_to_csv", convert)
+    best("data_to_csv_workers", lambda: convert(workers=os.cpu_count()))
+
+    def convert_stream():
+        out = work / "land_value.csv"
+        _, seconds = timed(nsw.data_to_csv, site, out, stream=True)
+        return result(seconds, dat_bytes, csv_rows(out))
+
+    best("data_to_csv_stream", convert_stream)
+
+    def end_to_end(*flags):
+        run = work / "run"
+        shutil.rmtree(run, ignore_errors=True)
+        run.mkdir()
+        argv = [
+            "--base_url", url,
+            "--download_path", str(run / "downloads"),
+            "--data_path", str(run / "extracted"),
+            "--pdf_path", str(run / "pdfs"),
+            "--csv_path", str(run / "land_value.csv"),
+            "--manifest_file", str(run / "manifest.txt"),
+            *flags,
+        ]
+        _, seconds = timed(nsw.main, argv)
+        return result(seconds, archive_bytes, csv_rows(run / "land_value.csv"))
+
+    with serve(site) as url:
+        best("main", end_to_end)
+        best("main_pipeline", lambda: end_to_end("--pipeline"))
+    return results
+
+
+def synthetic_rows(count, duplicate_rate=0.05, seed=0):
+    rng = random.Random(seed)
+    template = [f"{column}-value" for column in nsw.COLUMNS]
+    emitted = []
+    for i in range(count):
+        if emitted and rng.random() < duplicate_rate:
+            yield rng.choice(emitted)
+            continue
+        row = list(template)
+        row[0] = f"{i % 150:03d}"
+        row[2] = str(i)
+        row[14] = str(rng.randint(100000, 3000000))
+        row = tuple(row)
+        if len(emitted) < 10000:
+            emitted.append(row)
+        else:
+            emitted[i % 10000] = row
+        yield row
+
+
+def batches(rows, size=100000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bench_dedup(rows):
+    results = {}
+
+    # The original approach: hash(str(record)) of each record dict.
+    seen, unique, elapsed = set(), 0, 0.0
+    for batch in batches(synthetic_rows(rows)):
+        records = [dict(zip(nsw.COLUMNS, row)) for row in batch]
+        start = time.perf_counter()
+        for record in records:
+            hsh = hash(str(record))
+            if hsh not in seen:
+                seen.add(hsh)
+                unique += 1
+        elapsed += time.perf_counter() - start
+    nbytes = sys.getsizeof(seen) + sum(sys.getsizeof(h) for h in seen)
+    results["hash_str_dict"] = (unique, elapsed, nbytes)
+    del seen
+
+    seen, unique, elapsed = nsw.DedupIndex(), 0, 0.0
+    for batch in batches(synthetic_rows(rows)):
+        start = time.perf_counter()
+        for row in batch:
+            if seen.add(row):
+                unique += 1
+        elapsed += time.perf_counter() - start
+    results["dedup_index"] = (unique, elapsed, seen.nbytes)
+
+    print(f"{'method':<16}{'unique':>12}{'seconds':>10}{'rows/s':>12}{'MiB':>10}")
+    for name, (unique, elapsed, nbytes) in results.items():
+        print(
+            f"{name:<16}{unique:>12}{elapsed:>10.2f}{rows / elapsed:>12.0f}"
+            f"{nbytes / 2**20:>10.1f}"
+        )
+    return {
+        f"dedup_{name}": {
+            "seconds": round(elapsed, 4),
+            "records": rows,
+            "unique": unique,
+            "records_per_s": round(rows / elapsed, 1),
+            "memory_bytes": nbytes,
+        }
+        for name, (unique, elapsed, nbytes) in results.items()
+    }
+
+
+def write_results(json_path, benchmark, params, results):
+    report = {
+        "benchmark": benchmark,
+        "when": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+    with open(json_path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to '{json_path}'.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for nsw_property_sales.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    suite = subparsers.add_parser(
+        "suite", help="Parse, extract, convert and end-to-end runs on synthetic data"
+    )
+    suite.add_argument("--years", type=int, default=2, help="Yearly archives")
+    suite.add_argument("--weeks", type=int, default=8, help="Weekly files per year")
+    suite.add_argument("--districts", type=int, default=6, help="Districts per week")
+    suite.add_argument("--sales", type=int, default=300, help="Sales per file")
+    suite.add_argument("--repeat", type=int, default=3, help="Best of N runs")
+    suite.add_argument("--json", type=Path, help="Write machine readable results")
+
+    generate = subparsers.add_parser(
+        "generate", help="Write a synthetic copy of the download site"
+    )
+    generate.add_argument("site_path", type=Path, help="Directory to write to")
+    generate.add_argument("--years", type=int, default=2, help="Yearly archives")
+    generate.add_argument("--weeks", type=int, default=8, help="Weekly files per year")
+    generate.add_argument("--districts", type=int, default=6, help="Districts per week")
+    generate.add_argument("--sales", type=int, default=300, help="Sales per file")
+
+    dedup = subparsers.add_parser("dedup", help="Compare dedup strategies")
+    dedup.add_argument("--rows", type=int, default=1000000, help="Rows to dedup")
+    dedup.add_argument("--json", type=Path, help="Write machine readable results")
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("benchmark", "json")}
+    if args.benchmark == "suite":
+        with tempfile.TemporaryDirectory(prefix="nsw-bench-") as work:
+            results = bench_suite(
+                Path(work), args.years, args.weeks, args.districts, args.sales, args.repeat
+            )
+    elif args.benchmark == "generate":
+        generate_site(args.site_path, args.years, args.weeks, args.districts, args.sales)
+        print(f"Synthetic site written to '{args.site_path}' (serve index.html).")
+        return
+    else:
+        results = bench_dedup(args.rows)
+    if args.json:
+        write_results(args.json, args.benchmark, params, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,50 @@
 #!/usr/bin/env python3
 import argparse
+import base64
+import bisect
+import contextlib
+import cProfile
 import csv
+import gzip
+import hashlib
+import heapq
+import http.client
+import io
+import itertools
+import json
+import locale
+import lzma
+import marshal
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import random
 import re
 import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import zipfile
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
-from pathlib import Path
+import zlib
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import date, datetime
+from pathlib import Path, PurePosixPath
 from urllib import request, error
+from urllib.parse import urljoin, urlsplit
 
 BASE_URL = "https://valuation.property.nsw.gov.au/embed/propertySalesInformation"
 
@@ -234,14 +269,122 @@ COLUMNS = (
 MANIFEST = []
 
 
-def progress_tracker(total=None, operation="Working"):
+class Metrics:
+    # Wall-clock time per stage, plus one entry per file handled so the
+    # throughput of each stage can be broken down afterwards.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profile_path = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.files = []
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_file(self, stage, name, nbytes=0, records=None, seconds=None):
+        entry = {"stage": stage, "name": str(name), "bytes": nbytes}
+        if records is not None:
+            entry["records"] = records
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 6)
+        with self._lock:
+            self.files.append(entry)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = snapshot = None
+        if self.profile_path is not None:
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Newer Pythons allow a single active profiler, so a stage
+                # overlapping another one in the pipeline goes unprofiled.
+                profiler = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(Path(self.profile_path) / f"{name}.prof")
+            if snapshot is not None:
+                stats = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+                with open(Path(self.profile_path) / f"{name}.memory.txt", "w") as f:
+                    for stat in stats[:25]:
+                        f.write(f"{stat}\n")
+
+    def report(self):
+        with self._lock:
+            stages = {
+                name: {"seconds": round(seconds, 6)}
+                for name, seconds in self.stages.items()
+            }
+            for entry in self.files:
+                totals = stages.setdefault(entry["stage"], {"seconds": 0.0})
+                totals["files"] = totals.get("files", 0) + 1
+                totals["bytes"] = totals.get("bytes", 0) + entry["bytes"]
+                if "records" in entry:
+                    totals["records"] = totals.get("records", 0) + entry["records"]
+            for totals in stages.values():
+                if totals["seconds"]:
+                    if "bytes" in totals:
+                        totals["mib_per_s"] = round(
+                            totals["bytes"] / 2**20 / totals["seconds"], 3
+                        )
+                    if "records" in totals:
+                        totals["records_per_s"] = round(
+                            totals["records"] / totals["seconds"], 1
+                        )
+            return {
+                "stages": stages,
+                "counters": dict(self.counters),
+                "files": list(self.files),
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+METRICS = Metrics()
+
+
+def progress_tracker(total=None, operation="Working", interval=0.5):
     progress = [0]
     bytes_downloaded = [0]
     start_time = [time.time()]
+    # Downloads report every chunk from several threads, so the line is only
+    # redrawn a few times a second (and always once the total is reached).
+    last_render = [0.0]
+    lock = threading.Lock()
 
     def update_progress(_bytes=0, step=1):
-        progress[0] += step
-        elapsed_time = time.time() - start_time[0]
+        with lock:
+            progress[0] += step
+            if _bytes is not None:
+                bytes_downloaded[0] += _bytes
+            now = time.time()
+            done = bool(total) and progress[0] == total
+            if not done and now - last_render[0] < interval:
+                return
+            last_render[0] = now
+            render(now - start_time[0], done)
+
+    def render(elapsed_time, done):
         if total:
             percentage = (progress[0] / total) * 100
             percentage = f"({percentage:.2f}%)"
@@ -249,19 +392,13 @@ def progress_tracker(total=None, operation="Working"):
         else:
             _total = ""
             percentage = ""
-        if _bytes is not None:
-            bytes_downloaded[0] += _bytes
-            throughput = (bytes_downloaded[0] / 1024 / 1024) / elapsed_time
-            throughput = f" - {throughput:.2f} MiB/s"
-            btotal = bytes_downloaded[0] / 1024 / 1024
-            if btotal > 1024:
-                btotal = f" - {btotal/1024:.2f}GiB"
-            else:
-                btotal = f" - {btotal:.1f}MiB"
-
+        throughput = (bytes_downloaded[0] / 1024 / 1024) / max(elapsed_time, 1e-9)
+        throughput = f" - {throughput:.2f} MiB/s"
+        btotal = bytes_downloaded[0] / 1024 / 1024
+        if btotal > 1024:
+            btotal = f" - {btotal/1024:.2f}GiB"
         else:
-            throughput = ""
-            btotal = ""
+            btotal = f" - {btotal:.1f}MiB"
 
         outstr = f"\r{operation}: {progress[0]}{_total} files {percentage}{throughput}{btotal}"
         print(
@@ -269,9 +406,14 @@ def progress_tracker(total=None, operation="Working"):
             end="",
             flush=True,
         )
-        if total and progress[0] == total:
+        if done:
             print()
 
+    def flush():
+        with lock:
+            render(time.time() - start_time[0], False)
+
+    update_progress.flush = flush
     return update_progress
 
 
@@ -280,52 +422,366 @@ def fetch_sales_data(url, headers):
     req = request.Request(url, headers=headers)
     with request.urlopen(req) as response:
         html = response.read().decode("utf-8")
-    return re.findall('href="([^"]+(zip|pdf))"', html)
+    links = re.findall('href="([^"]+(zip|pdf))"', html)
+    return [(urljoin(url, link), fkind) for link, fkind in links]
+
+
+def load_download_state(state_path):
+    if state_path is None or not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_download_state(state_path, state):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+
+class ConnectionPool:
+    # Keeps idle HTTP/1.1 connections per host so consecutive downloads reuse
+    # them instead of paying for a new TCP and TLS handshake each time.
+    def __init__(self, headers=None, timeout=60):
+        self._headers = headers or {}
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        # http_proxy, https_proxy and no_proxy, as urlopen would use them.
+        self._proxies = request.getproxies()
+        self._proxy_for = {}
+
+    def _proxy(self, scheme, netloc):
+        # (proxy netloc, headers for the proxy) or None to connect directly.
+        key = (scheme, netloc)
+        if key not in self._proxy_for:
+            proxy = self._proxies.get(scheme)
+            if proxy is None or request.proxy_bypass(netloc):
+                self._proxy_for[key] = None
+            else:
+                if "://" not in proxy:
+                    proxy = "http://" + proxy
+                parts = urlsplit(proxy)
+                headers = {}
+                if parts.username is not None:
+                    credentials = f"{parts.username}:{parts.password or ''}"
+                    token = base64.b64encode(credentials.encode()).decode("ascii")
+                    headers["Proxy-Authorization"] = f"Basic {token}"
+                netloc = parts.netloc.rpartition("@")[2]
+                self._proxy_for[key] = (netloc, headers)
+        return self._proxy_for[key]
+
+    def _connect(self, scheme, netloc):
+        proxy = self._proxy(scheme, netloc)
+        if proxy is not None and scheme == "https":
+            # TLS to the server through a CONNECT tunnel on the proxy.
+            proxy_netloc, proxy_headers = proxy
+            conn = http.client.HTTPSConnection(proxy_netloc, timeout=self._timeout)
+            conn.set_tunnel(netloc, headers=proxy_headers)
+            return conn
+        if proxy is not None:
+            return http.client.HTTPConnection(proxy[0], timeout=self._timeout)
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self._timeout)
+        return http.client.HTTPConnection(netloc, timeout=self._timeout)
+
+    def _checkout(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self._connect(scheme, netloc), False
+
+    def _checkin(self, scheme, netloc, conn, response):
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault((scheme, netloc), []).append(conn)
+        else:
+            conn.close()
+
+    def _send(self, scheme, netloc, path, headers):
+        proxy = self._proxy(scheme, netloc)
+        if proxy is not None and scheme == "http":
+            # Plain HTTP proxies take the whole URL in the request line.
+            path = f"{scheme}://{netloc}{path}"
+            headers = {**headers, **proxy[1]}
+        conn, reused = self._checkout(scheme, netloc)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+        # The server dropped the idle connection, try once on a fresh one.
+        conn = self._connect(scheme, netloc)
+        conn.request("GET", path, headers=headers)
+        return conn, conn.getresponse()
+
+    @contextlib.contextmanager
+    def get(self, url, headers=None, max_redirects=5):
+        headers = {**self._headers, **(headers or {})}
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            conn, response = self._send(parts.scheme, parts.netloc, path, headers)
+            if response.status in (200, 206):
+                break
+            response.read()
+            self._checkin(parts.scheme, parts.netloc, conn, response)
+            location = response.getheader("Location")
+            if response.status not in REDIRECT_STATUS or not location:
+                raise error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            url = urljoin(url, location)
+        else:
+            raise error.HTTPError(url, response.status, "Too many redirects", None, None)
+        try:
+            yield response
+        finally:
+            self._checkin(parts.scheme, parts.netloc, conn, response)
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle.clear()
+
+
+class AdaptiveLimiter:
+    # Caps concurrent downloads. The cap halves whenever the server pushes
+    # back (429/5xx) and otherwise climbs by one per window of completed
+    # downloads, unless the last increase made aggregate throughput drop.
+    def __init__(self, max_limit, initial=4):
+        self.max_limit = max_limit
+        self.limit = min(initial, max_limit)
+        self._active = 0
+        self._cond = threading.Condition()
+        self._reset_window()
+        self._last_rate = None
+        self._grew = False
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, nbytes=0, throttled=False):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self._last_rate, self._grew = None, False
+                self._reset_window()
+            else:
+                self._window_bytes += nbytes
+                self._window_count += 1
+                if self._window_count >= self.limit:
+                    elapsed = max(time.monotonic() - self._window_start, 1e-6)
+                    rate = self._window_bytes / elapsed
+                    if self._grew and self._last_rate and rate < 0.8 * self._last_rate:
+                        self.limit, self._grew = max(1, self.limit - 1), False
+                    elif self.limit < self.max_limit:
+                        self.limit, self._grew = self.limit + 1, True
+                    else:
+                        self._grew = False
+                    self._last_rate = rate
+                    self._reset_window()
+            self._cond.notify_all()
+
+
+class DownloadError(Exception):
+    pass
+
 
+def _backoff(attempt, base=1.0, cap=60.0):
+    # Exponential backoff with full jitter, so threads retrying against the
+    # same server don't do it in lockstep.
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _download_attempt(url, part_path, progress, known, progress_update, pool):
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and progress["validator"]:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = progress["validator"]
+    elif known is not None:
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
 
-def download_file(url, directory, progress_update):
     try:
-        file_name = url.split("/")[-1]
-        file_path = os.path.join(directory, file_name)
-
-        with request.urlopen(url) as response:
-            # Get the total file size from headers if available
-            total_size = response.getheader("Content-Length")
-            if total_size is not None:
-                total_size = int(total_size)
+        with pool.get(url, headers) as response:
+            if response.status == 206:
+                # Resuming, Content-Range is "bytes start-end/total".
+                total_size = response.getheader("Content-Range", "").rpartition("/")[2]
+                mode = "ab"
             else:
-                total_size = 0  # Unknown size
+                total_size = response.getheader("Content-Length")
+                offset, mode = 0, "wb"
+                progress["digest"] = hashlib.sha256()
+                progress["etag"] = response.getheader("ETag")
+                progress["last_modified"] = response.getheader("Last-Modified")
+                etag = progress["etag"]
+                # Weak ETags can't be used to resume a download.
+                if etag and not etag.startswith("W/"):
+                    progress["validator"] = etag
+                else:
+                    progress["validator"] = progress["last_modified"]
+            total_size = int(total_size) if total_size and total_size.isdigit() else None
 
-            downloaded_size = 0
             chunk_size = 1024 * 1024  # 1 MB per chunk
-
-            with open(file_path, "wb") as out_file:
+            with open(part_path, mode) as out_file:
                 while True:
                     data = response.read(chunk_size)
                     if not data:
                         break
                     out_file.write(data)
-                    downloaded_size += len(data)
+                    progress["digest"].update(data)
+                    offset += len(data)
                     progress_update(len(data), step=0)
-            progress_update(0, step=1)
-            MANIFEST.append(file_path)
-
-        return file_path, downloaded_size
     except error.HTTPError as e:
-        print(f"HTTP Error: {e.code} {e.reason} {url}")
-    except error.URLError as e:
-        print(f"URL Error: {e.reason} {url}")
-    return None, 0
+        if e.code == 304 and known is not None:
+            return False
+        raise
+    if total_size is not None and offset != total_size:
+        raise ConnectionError(f"received {offset} of {total_size} bytes")
+    progress["size"] = offset
+    return True
+
+
+def download_file(url, directory, progress_update, state=None, retries=5,
+                  pool=None, limiter=None):
+    file_name = url.split("/")[-1]
+    file_path = os.path.join(directory, file_name)
+    part_path = f"{file_path}.part"
+    start = time.perf_counter()
+    # A partial file left by an earlier run can't be matched to a version of
+    # the file, so only downloads interrupted during this run are resumed.
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+    known = state.get(url) if state is not None else None
+    if known is not None and (
+        not os.path.exists(file_path) or os.path.getsize(file_path) != known["size"]
+    ):
+        known = None
+
+    pool = ConnectionPool() if pool is None else pool
+    progress = {"validator": None}
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        throttled = False
+        try:
+            changed = _download_attempt(
+                url, part_path, progress, known, progress_update, pool
+            )
+            break
+        except error.HTTPError as e:
+            throttled = e.code in THROTTLE_STATUS
+            if e.code not in RETRY_STATUS or attempt == retries:
+                raise DownloadError(f"HTTP Error: {e.code} {e.reason} {url}") from e
+            reason = f"HTTP {e.code}"
+        except (error.URLError, http.client.HTTPException, OSError) as e:
+            if attempt == retries:
+                raise DownloadError(f"Download failed: {e} {url}") from e
+            reason = e
+        finally:
+            if limiter is not None:
+                if os.path.exists(part_path):
+                    received = os.path.getsize(part_path) - received
+                limiter.release(max(received, 0), throttled)
+        delay = _backoff(attempt)
+        METRICS.count("download_retries")
+        print(f"\nRetrying {url} in {delay:.1f}s ({reason}).")
+        time.sleep(delay)
+
+    progress_update(0, step=1)
+    MANIFEST.append(file_path)
+    if not changed:
+        # Not modified since the last run, the local copy is current.
+        METRICS.count("download_not_modified")
+        METRICS.record_file("download", file_name, 0, seconds=time.perf_counter() - start)
+        return file_path, 0
+    try:
+        os.replace(part_path, file_path)
+    except OSError as e:
+        # e.g. another process writing to the same directory removed it.
+        raise DownloadError(f"Download failed: {e} {url}") from e
+    if state is not None:
+        state[url] = {
+            "file_name": file_name,
+            "size": progress["size"],
+            "etag": progress["etag"],
+            "last_modified": progress["last_modified"],
+            "sha256": progress["digest"].hexdigest(),
+        }
+    METRICS.record_file(
+        "download", file_name, progress["size"], seconds=time.perf_counter() - start
+    )
+    return file_path, progress["size"]
 
 
-def fetch_data(download_path, pdf_path):
+def fetch_data(download_path, pdf_path, url=BASE_URL, state=None, on_download=None,
+               max_connections=8, keep=None, select=None, pdfs=True):
     headers = {
         "User-Agent": "Mozilla/5.0",
     }
-    links = fetch_sales_data(BASE_URL, headers)
+    with METRICS.stage("listing"):
+        links = fetch_sales_data(url, headers)
+    METRICS.count("listed_files", len(links))
+    if keep is not None or select is not None or not pdfs:
+        # Archives keep(name) or select(name) rejects aren't downloaded at all,
+        # nor are the PDFs unless pdfs is set.
+        kept = []
+        for link, fkind in links:
+            name = urlsplit(link).path.rsplit("/", 1)[-1]
+            if fkind == "pdf" and not pdfs:
+                continue
+            if fkind == "zip" and keep is not None and not keep(name):
+                continue
+            if fkind == "zip" and select is not None and not select(name):
+                continue
+            kept.append((link, fkind))
+        archives = [link for link, fkind in links if fkind == "zip"]
+        kept_archives = [link for link, fkind in kept if fkind == "zip"]
+        METRICS.count("skipped_archives", len(archives) - len(kept_archives))
+        links = kept
     tracker = progress_tracker(len(links), "Downloading")
-    futures = []
-    with ThreadPoolExecutor() as executor:
+    pool = ConnectionPool(headers)
+    limiter = AdaptiveLimiter(max_connections)
+    futures = {}
+    failures = []
+    # on_download sees the archives in name order, the order a --stream run
+    # reads them in, whatever order they finish in. Early finishers wait in
+    # finished, they're already on disk. Downloads start in the same order,
+    # so the next archive needed is usually among the first to finish.
+    links = sorted(links, key=lambda item: item[0].split("/")[-1])
+    order = [link for link, fkind in links if fkind == "zip"]
+    archives = set(order)
+    finished = {}
+    released = 0
+    with METRICS.stage("download"), contextlib.closing(pool), ThreadPoolExecutor(
+        max_connections
+    ) as executor:
         for link, fkind in links:
             if fkind == "pdf":
                 out_path = pdf_path
@@ -334,327 +790,3070 @@ def fetch_data(download_path, pdf_path):
             else:
                 print("Unknown file type:", fkind)
                 continue
-            futures.append(executor.submit(download_file, link, out_path, tracker))
-        for future in futures:
-            future.result()
+            future = executor.submit(
+                download_file, link, out_path, tracker, state, pool=pool, limiter=limiter
+            )
+            futures[future] = link
+        try:
+            for future in as_completed(futures):
+                try:
+                    file_path, _ = future.result()
+                except DownloadError as e:
+                    failures.append(str(e))
+                    file_path = None
+                link = futures[future]
+                if on_download is None or link not in archives:
+                    continue
+                finished[link] = file_path
+                while released < len(order) and order[released] in finished:
+                    file_path = finished.pop(order[released])
+                    released += 1
+                    if file_path is not None:
+                        on_download(file_path)
+        except BaseException:
+            # Leaving the executor waits for every queued download, so drop
+            # the ones that haven't started when on_download (or ^C) stops us.
+            for future in futures:
+                future.cancel()
+            raise
+    if failures:
+        tracker.flush()
+        print()
+        for failure in failures:
+            print(failure)
+        raise DownloadError(f"{len(failures)} of {len(futures)} downloads failed.")
+
 
+def _escape_name(name):
+    # Extracted files are named after the chain of archives (joined by "--")
+    # and folders in them (joined by "-") a member came from, which is unique
+    # once "-" can't appear inside a name, so no need to check what's already
+    # on disk.
+    return name.replace("%", "%25").replace("-", "%2D")
 
-def extract_zip(file_path, target_path):
+
+def extract_archive(archive, origin, extracted_path, data_path, remove=True,
+                    keep=None):
+    # Data files go straight to data_path, nested archives are written to
+    # extracted_path and returned for the caller to queue up. Members that
+    # keep(name) rejects are left in the archive.
+    nested, dat_files = [], []
     try:
-        with zipfile.ZipFile(file_path, "r") as zip_ref:
-            zip_ref.extractall(target_path)
-        os.remove(file_path)
+        with zipfile.ZipFile(archive, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                member = PurePosixPath(info.filename)
+                if keep is not None and not keep(member.name):
+                    continue
+                folders = "-".join((origin, *map(_escape_name, member.parent.parts)))
+                if member.suffix == ".zip":
+                    member_origin = f"{folders}--{_escape_name(member.stem)}"
+                    name = member_origin + ".zip"
+                    dst_path = Path(extracted_path) / name
+                    nested.append((dst_path, member_origin, info.file_size))
+                elif member.suffix == ".DAT":
+                    # The data file's own name comes first so extracted
+                    # files still sort by date.
+                    name = f"{_escape_name(member.stem)}-{folders}.DAT"
+                    dst_path = Path(data_path) / name
+                    dat_files.append((dst_path, info.file_size))
+                else:
+                    continue
+                with zip_ref.open(info) as src, open(dst_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
     except zipfile.BadZipFile:
-        print(f"Failed to extract {file_path}, not a zip file.")
+        print(f"Failed to extract {archive}, not a zip file.")
         raise
+    if remove:
+        os.remove(archive)
+    return nested, dat_files
+
+
+def process_downloaded_files(extracted_path, data_path, source_path=None,
+                             workers=None, keep=None, select=None):
+    with METRICS.stage("extract"):
+        _process_downloaded_files(
+            extracted_path, data_path, source_path, workers, keep, select
+        )
 
 
-def process_downloaded_files(extracted_path, data_path):
+def _process_downloaded_files(extracted_path, data_path, source_path=None,
+                              workers=None, keep=None, select=None):
+    # keep(name) is asked about every archive and data file, select(name)
+    # only about the downloaded archives.
     tracker = progress_tracker(None, "Extracting")
-    zip_found = True
-    while zip_found:
-        zip_found = False
-        for root, _, files in os.walk(extracted_path):
-            for file in files:
-                src_path = os.path.join(root, file)
-                if file.endswith(".DAT") or file.endswith(".zip"):
-                    dst_dir = data_path if file.endswith(".DAT") else extracted_path
-                    index = 0
-                    base, extension = os.path.splitext(file)
-                    dst_path = os.path.join(dst_dir, f"{base}_{index}{extension}")
-                    while os.path.exists(dst_path):
-                        dst_path = os.path.join(dst_dir, f"{base}_{index}{extension}")
-                        index += 1
-                    shutil.move(src_path, dst_path)
-                    MANIFEST.append(dst_path)
-                    tracker(Path(dst_path).stat().st_size)
-                    if file.endswith(".zip"):
-                        extract_zip(dst_path, extracted_path)
-                        zip_found = True
+    Path(extracted_path).mkdir(parents=True, exist_ok=True)
+    # Leave the downloaded archives in place when extracting from source_path
+    # so the next incremental run can compare them against the server instead
+    # of fetching them again. Nested archives are always removed once done.
+    remove = source_path is None
+    archives = sorted(Path(extracted_path if remove else source_path).glob("*.zip"))
+    if keep is not None:
+        archives = [archive for archive in archives if keep(archive.name)]
+    if select is not None:
+        archives = [archive for archive in archives if select(archive.name)]
+    with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+        pending = {}
+
+        def submit(archive, origin, size, remove):
+            future = executor.submit(
+                extract_archive,
+                archive,
+                origin,
+                extracted_path,
+                data_path,
+                remove,
+                keep,
+            )
+            pending[future] = (archive, size)
+
+        for archive in archives:
+            submit(archive, _escape_name(archive.stem), archive.stat().st_size, remove)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                archive, size = pending.pop(future)
+                nested, dat_files = future.result()
+                METRICS.record_file("extract", archive, size)
+                tracker(size)
+                for path, origin, size in nested:
+                    submit(path, origin, size, True)
+                for path, size in dat_files:
+                    MANIFEST.append(path)
+                    METRICS.record_file("extract", path, size)
+                    tracker(size)
+    tracker.flush()
     print(flush=True)
 
 
-def parse_1990_file(file_path):
-    # Initialize containers for different types of records
-    data = {"HEADER": None, "SALES": [], "FOOTER": None}
+def iter_zip_dat_files(zip_file, prefix="", keep=None):
+    # Members that keep(name) rejects are skipped without decompressing them.
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for info in zip_ref.infolist():
+            name = prefix + info.filename
+            if keep is not None and not keep(info.filename):
+                continue
+            if info.filename.endswith(".zip"):
+                with zip_ref.open(info) as member:
+                    if info.compress_type == zipfile.ZIP_STORED:
+                        yield from iter_zip_dat_files(member, name + "/", keep)
+                    else:
+                        # Seeking backwards in a compressed member restarts
+                        # decompression, so buffer the (small) inner archive.
+                        inner = io.BytesIO(member.read())
+                        yield from iter_zip_dat_files(inner, name + "/", keep)
+            elif info.filename.endswith(".DAT"):
+                with zip_ref.open(info) as member:
+                    yield name, info.file_size, member
 
-    with open(file_path, "r") as file:
-        for line in file:
-            parts = line.strip().split(";")
-            record_type = parts[0]
 
-            if record_type == "A":  # Header record
-                data["HEADER"] = {
-                    "record_type": parts[0],
-                    "district_code": parts[1],
-                    "source": parts[2],
-                    "download_datetime": parts[3],
-                    "submitter_user_id": parts[4],
-                }
-            elif record_type == "B":  # Sales record
-                area_type = {"M": "Square Meters", "H": "Hectares"}.get(
-                    parts[14], parts[14]
-                )
-                contract_date = "".join(parts[10].split("/")[::-1])
-                data["SALES"].append(
-                    {
-                        # 'record_type': parts[0],
-                        "district_code": parts[1],
-                        "district_name": CODE_TO_DISTRICT.get(parts[1].strip(), ""),
-                        "property_id": parts[4],  # Removed the period
-                        # 'source': parts[2],
-                        # 'valuation_num': parts[3],
-                        # "sale_counter": "",
-                        "file_datetime": data["HEADER"]["download_datetime"],
-                        "property_name": "",
-                        "property_unit_number": parts[5],
-                        "property_house_number": parts[6],
-                        "property_street_name": parts[7],
-                        "property_locality": parts[8],
-                        "property_post_code": parts[9],
-                        "area": parts[13],
-                        "area_type": area_type,
-                        "contract_date": contract_date,
-                        "settlement_date": contract_date,
-                        "purchase_price": parts[11],
-                        "zone_code": parts[17],
-                        "zone_name": CODE_TO_ZONE.get(parts[17].strip(), ""),
-                        "nature_property": "",
-                        "primary_purpose": "",
-                        "strata_number": "",
-                        "component_code": parts[16],
-                        "sale_code": "",
-                        "interest_sale": "",
-                        "dealing_number": "",
-                        "property_description": parts[12],
-                        "purchaser_vendor": "",
-                        "dimensions": parts[15],
-                        "filetype": "archive",
-                    }
-                )
-            elif record_type == "Z":  # Footer record
-                data["FOOTER"] = {
-                    "record_type": parts[0],
-                    "total_records": parts[1],
-                    "total_B_records": parts[2],
-                }
+def stream_dat_files(archive_path, keep=None, select=None):
+    for archive in sorted(Path(archive_path).glob("*.zip")):
+        if keep is not None and not keep(archive.name):
+            continue
+        if select is not None and not select(archive.name):
+            continue
+        try:
+            yield from iter_zip_dat_files(archive, archive.name + "/", keep)
+        except zipfile.BadZipFile:
+            print(f"Failed to read {archive}, not a zip file.")
+            raise
 
-    return data
 
+# Decoding is pinned to UTF-8 rather than left to the locale, and strict, so
+# a file that isn't valid UTF-8 fails the run with its name instead of having
+# its text (and dedup keys) quietly changed.
+DAT_ENCODING = "utf-8"
+DAT_ERRORS = "strict"
+
+
+@contextlib.contextmanager
+def open_dat_buffer(file_path):
+    if hasattr(file_path, "read"):
+        yield file_path.read()
+        return
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+
+AREA_TYPES = {"M": "Square Meters", "H": "Hectares"}
+NATURE_OF_PROPERTY = {"V": "Vacant", "R": "Residence", "3": "Other"}
+PURCHASER_VENDOR = {"P": "Purchaser", "V": "Vendor"}
+
+
+def _archive_header(parts):
+    return {
+        "record_type": parts[0],
+        "district_code": parts[1],
+        "source": parts[2],
+        "download_datetime": parts[3],
+        "submitter_user_id": parts[4],
+    }
+
+
+def _archive_footer(parts):
+    return {
+        "record_type": parts[0],
+        "total_records": parts[1],
+        "total_B_records": parts[2],
+    }
+
+
+def _archive_contract_date(parts):
+    return "".join(parts[10].split("/")[::-1])
+
+
+def _archive_sale(parts, header):
+    contract_date = _archive_contract_date(parts)
+    return (
+        parts[1],
+        CODE_TO_DISTRICT.get(parts[1].strip(), ""),
+        parts[4],
+        header["download_datetime"],
+        "",
+        parts[5],
+        parts[6],
+        parts[7],
+        parts[8],
+        parts[9],
+        parts[13],
+        AREA_TYPES.get(parts[14], parts[14]),
+        contract_date,
+        contract_date,
+        parts[11],
+        parts[17],
+        CODE_TO_ZONE.get(parts[17].strip(), ""),
+        "",
+        "",
+        "",
+        parts[16],
+        "",
+        "",
+        "",
+        parts[12],
+        "",
+        parts[15],
+        "archive",
+    )
+
+
+def _sales_data_header(parts):
+    if len(parts) == 5:
+        parts = [parts[0]] + ["NA"] + parts[1:]
+    if len(parts) != 6:
+        raise ValueError("Invalid File Header:", ";".join(parts))
+    return {
+        "file_type": parts[1],
+        "district_code": parts[2],
+        "download_datetime": parts[3],
+        "submitter_user_id": parts[4],
+    }
+
+
+def _sales_data_footer(parts):
+    return {
+        "total_records": parts[1],
+        "total_B_records": parts[2],
+        "total_C_records": parts[3],
+        "total_D_records": parts[4],
+    }
+
+
+def _sales_data_sale(parts, header, description="", purchaser_vendor=""):
+    # property_description and purchaser_vendor come from the C and D records
+    # that follow.
+    return (
+        parts[1],
+        CODE_TO_DISTRICT.get(parts[1].strip(), ""),
+        parts[2],
+        parts[4],
+        parts[5],
+        parts[6],
+        parts[7],
+        parts[8],
+        parts[9],
+        parts[10],
+        parts[11],
+        AREA_TYPES.get(parts[12], parts[12]),
+        parts[13],
+        parts[14],
+        parts[15],
+        parts[16],
+        CODE_TO_ZONE.get(parts[16].strip(), ""),
+        NATURE_OF_PROPERTY.get(parts[17], parts[17]),
+        parts[18],
+        parts[19],
+        parts[20],
+        parts[21],
+        parts[22],
+        parts[23],
+        description,
+        purchaser_vendor,
+        "",
+        "sales",
+    )
 
-def parse_sales_data_file(file_path):
-    with open(file_path, "r") as file:
-        data = {"HEADER": None, "FOOTER": None, "SALES": []}
-        sales_index = {}  # To index sales entries by the first 5 columns
 
-        counter = {"A": 0, "B": 0, "C": 0, "D": 0, "Z": 0}
-        for line in file:
+# Record builders for each file format. Only the sales data format has C/D
+# records (continued), which continue the B record before them and are passed
+# to its sale builder once they're all in.
+RecordFormat = namedtuple("RecordFormat", ("header", "sale", "footer", "continued"))
+ARCHIVE_FORMAT = RecordFormat(_archive_header, _archive_sale, _archive_footer, False)
+SALES_DATA_FORMAT = RecordFormat(
+    _sales_data_header, _sales_data_sale, _sales_data_footer, True
+)
+
+
+def _iter_line_chunks(buffer, chunk_size=1 << 20):
+    # Blocks of whole lines, so a large file is decoded a piece at a time
+    # rather than copied out of the mmap in one go.
+    start, size = 0, len(buffer)
+    while start < size:
+        end = start + chunk_size
+        if end < size:
+            cut = max(buffer.rfind(b"\n", start, end), buffer.rfind(b"\r", start, end))
+            if cut < start:
+                # A single line longer than the chunk.
+                ends = [buffer.find(b"\n", end), buffer.find(b"\r", end)]
+                ends = [i for i in ends if i >= 0]
+                cut = min(ends) if ends else size - 1
+            end = cut + 1
+        yield buffer[start:end]
+        start = end
+
+
+def iter_sale_records(buffer, record_format, data=None, keep=None,
+                      chunk_size=1 << 20):
+    # Sales as tuples in COLUMNS order, from the raw bytes of a file (usually
+    # an mmap), decoded a block of lines at a time. C and D records that start
+    # with the key of the current sale have their one useful field sliced out
+    # without stripping and splitting the whole line, and each sale is built
+    # once it is complete rather than patched afterwards. B records that
+    # keep(parts) rejects are never built, their C/D records are collected
+    # and thrown away at the next B record.
+    make_sale, continued = record_format.sale, record_format.continued
+    header = sale = key = None
+    # Lines never contain a line break, so this matches nothing until a sale
+    # has been seen.
+    prefixes = "\n"
+    prefix_length = 0
+    descriptions, parties = [], []
+    for chunk in _iter_line_chunks(buffer, chunk_size):
+        text = chunk.decode(DAT_ENCODING, DAT_ERRORS)
+        for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+            if line.startswith(prefixes):
+                end = line.find(";", prefix_length)
+                if end >= 0:
+                    value = line[prefix_length:end]
+                    if line[0] == "C":
+                        descriptions.append(value)
+                    else:
+                        parties.append(PURCHASER_VENDOR.get(value, value))
+                    continue
+            # Blank and ;;;; padding lines fall through, an empty record type
+            # matches nothing below.
             line = line.strip()
-            if line == "" or set(line) == {";"}:
-                continue
             parts = line.split(";")
-            segments = len(parts)
             record_type = parts[0]
+            if record_type == "B":
+                if sale is not None:
+                    if continued:
+                        description = "".join(descriptions)
+                        purchaser_vendor = ", ".join(parties)
+                        sale = make_sale(sale, header, description, purchaser_vendor)
+                    yield sale
+                    sale = None
+                descriptions, parties = [], []
+                if not continued:
+                    if header is None:
+                        raise ValueError("Sale record before file header:", line)
+                    if keep is None or keep(parts):
+                        # Archive sales have no C/D records, build them
+                        # straight away.
+                        sale = make_sale(parts, header)
+                    continue
+                if keep is None or keep(parts):
+                    # Built once its C/D records are in.
+                    sale = parts
+                key = parts[1:5]
+                joined = ";".join(key)
+                prefixes = (f"C;{joined};", f"D;{joined};") if len(parts) > 5 else "\n"
+                prefix_length = len(prefixes[0])
+            elif record_type == "C":
+                if parts[1:5] == key:
+                    descriptions.append(parts[5])
+            elif record_type == "D":
+                if parts[1:5] == key:
+                    parties.append(PURCHASER_VENDOR.get(parts[5], parts[5]))
+            elif record_type == "A":
+                header = record_format.header(parts)
+                if data is not None:
+                    data["HEADER"] = header
+            elif record_type == "Z":
+                if data is not None:
+                    data["FOOTER"] = record_format.footer(parts)
+    if sale is not None:
+        if continued:
+            sale = make_sale(sale, header, "".join(descriptions), ", ".join(parties))
+        yield sale
 
-            key = tuple(parts[1:5])  # First 5 columns as a tuple to use as a key
-
-            counter[record_type] += 1
-            if record_type == "A":  # Header
-                if segments == 5:
-                    parts = [parts[0]] + ["NA"] + parts[1:]
-                if len(parts) != 6:
-                    raise ValueError("Invalid File Header:", line)
 
-                data["HEADER"] = {
-                    "file_type": parts[1],
-                    "district_code": parts[2],
-                    "download_datetime": parts[3],
-                    "submitter_user_id": parts[4],
-                }
-            elif record_type == "Z":  # Footer
-                data["FOOTER"] = {
-                    "total_records": parts[1],
-                    "total_B_records": parts[2],
-                    "total_C_records": parts[3],
-                    "total_D_records": parts[4],
-                }
-            elif record_type == "B":  # New sale entry
-                if len(data["SALES"]) > 0:
-                    last = data["SALES"][-1]
-                    last_desc = last["property_description"]
-                    if isinstance(last_desc, list):
-                        last["property_description"] = "".join(last_desc)
-
-                    last_perch = last["purchaser_vendor"]
-                    if isinstance(last_perch, list):
-                        last["purchaser_vendor"] = ", ".join(last_perch)
-
-                area_type = {"M": "Square Meters", "H": "Hectares"}.get(
-                    parts[12], parts[12]
-                )
-                nature_property = {"V": "Vacant", "R": "Residence", "3": "Other"}.get(
-                    parts[17], parts[17]
-                )
-                sales_index[key] = {
-                    # 'Record Type': parts[0],
-                    "district_code": parts[1],
-                    "district_name": CODE_TO_DISTRICT.get(parts[1].strip(), ""),
-                    "property_id": parts[2],
-                    # "sale_counter": parts[3],
-                    "file_datetime": parts[4],
-                    "property_name": parts[5],
-                    "property_unit_number": parts[6],
-                    "property_house_number": parts[7],
-                    "property_street_name": parts[8],
-                    "property_locality": parts[9],
-                    "property_post_code": parts[10],
-                    "area": parts[11],
-                    "area_type": area_type,
-                    "contract_date": parts[13],
-                    "settlement_date": parts[14],
-                    "purchase_price": parts[15],
-                    "zone_code": parts[16],
-                    "zone_name": CODE_TO_ZONE.get(parts[16].strip(), ""),
-                    "nature_property": nature_property,
-                    "primary_purpose": parts[18],
-                    "strata_number": parts[19],
-                    "component_code": parts[20],
-                    "sale_code": parts[21],
-                    # Changed from '% Interest Sale' for valid identifier
-                    "interest_sale": parts[22],
-                    "dealing_number": parts[23],
-                    "property_description": [],  # List to hold multiple C records
-                    "purchaser_vendor": [],  # List to hold multiple D records, changed from 'Purchaser – Vendor'
-                    "dimensions": "",
-                    "filetype": "sales",
-                }
-                data["SALES"].append(sales_index[key])
-            elif record_type == "C" and key in sales_index:
-                sales_index[key]["property_description"].append(parts[5])
-            elif record_type == "D" and key in sales_index:
-                purchaser_vendor = {"P": "Purchaser", "V": "Vendor"}.get(
-                    parts[5], parts[5]
-                )
-                sales_index[key]["purchaser_vendor"].append(purchaser_vendor)
-
-    counter["records"] = sum(counter.values())
-    # validate = {k.split("_")[1]: int(v) for k, v in data["FOOTER"].items()}
-    # assert all(counter[k] == validate[k] for k in validate), (file_path, counter, validate)
-    if len(data["SALES"]) > 0:
-        last = data["SALES"][-1]
-        last_desc = last["property_description"]
-        if isinstance(last_desc, list):
-            last["property_description"] = "".join(last_desc)
-
-        last_perch = last["purchaser_vendor"]
-        if isinstance(last_perch, list):
-            last["purchaser_vendor"] = ", ".join(last_perch)
+def _parse_file(file_path, record_format):
+    data = {"HEADER": None, "SALES": [], "FOOTER": None}
+    with open_dat_buffer(file_path) as buffer:
+        for row in iter_sale_records(buffer, record_format, data):
+            data["SALES"].append(dict(zip(COLUMNS, row)))
     return data
 
 
-def handle_path(path):
+def parse_1990_file(file_path):
+    return _parse_file(file_path, ARCHIVE_FORMAT)
+
+
+def parse_sales_data_file(file_path):
+    return _parse_file(file_path, SALES_DATA_FORMAT)
+
+
+def record_format_for(name):
+    if "ARCHIVE_SALES" in name:
+        return ARCHIVE_FORMAT
+    if "SALES_DATA_NNME" in name:
+        return SALES_DATA_FORMAT
+    return None
+
+
+# Bump whenever a change to the parser changes the rows it produces, cached
+# parses from older versions are then discarded.
+PARSER_VERSION = 2
+
+RECORD_FORMAT_NAMES = {ARCHIVE_FORMAT: "archive", SALES_DATA_FORMAT: "sales_data"}
+
+# Contract date (YYYYMMDD) of a B record, before the sale is built.
+RECORD_CONTRACT_DATES = {
+    ARCHIVE_FORMAT: _archive_contract_date,
+    SALES_DATA_FORMAT: lambda parts: parts[13],
+}
+
+
+def handle_path(path, file=None, filters=None):
+    # filters are record_filter's keyword arguments, kept as plain values so
+    # they can be sent to worker processes.
+    record_format = record_format_for(Path(path).name)
+    if record_format is None:
+        return
+    keep = None if filters is None else record_filter(record_format, **filters)
     try:
-        if "ARCHIVE_SALES" in path.name:
-            res = parse_1990_file(path)
-            res = res["SALES"]
-        elif "SALES_DATA_NNME" in path.name:
-            res = parse_sales_data_file(path)
-            res = res["SALES"]
-        else:
-            res = []
-        return res
+        with open_dat_buffer(path if file is None else file) as buffer:
+            yield from iter_sale_records(buffer, record_format, keep=keep)
     except:
         print("Failed on:", path)
         raise
 
 
-def data_to_csv(base, out_path):
-    paths = list(Path(base).glob("*.DAT"))
-    tracker = progress_tracker(len(paths), "Parsing")
-    seen = set()
-    with open(out_path, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=COLUMNS, extrasaction="ignore")
-        writer.writeheader()
-        for path in paths:
-            res = handle_path(path)
-            for record in res:
-                hsh = hash(str(record))
-                if hsh in seen:
-                    continue
-                writer.writerow(record)
-                seen.add(hsh)
-            tracker(path.stat().st_size)
-    MANIFEST.append(out_path)
+Sale = namedtuple("Sale", COLUMNS)
 
 
-def write_manifest(manifest_path, when):
-    MANIFEST.append(manifest_path)
-    with open(manifest_path, "w") as f:
-        f.write(f"NSW Land Data Manifest (as of {when})\n\n")
-        for line in MANIFEST:
-            f.write(str(line) + "\n")
+def iter_source_files(source, keep=None):
+    source = Path(source)
+    if source.is_dir():
+        for path in sorted(source.rglob("*")):
+            if path.name.endswith(".zip"):
+                if keep is None or keep(path.name):
+                    yield from iter_zip_dat_files(path, f"{path}/", keep)
+            elif path.name.endswith(".DAT"):
+                yield path, path.stat().st_size, None
+    elif source.name.endswith(".zip"):
+        yield from iter_zip_dat_files(source, f"{source}/", keep)
+    else:
+        yield source, source.stat().st_size, None
 
 
-def main():
-    start = time.time()
-    parser = argparse.ArgumentParser(description="Process some integers.")
-    parser.add_argument(
-        "--download_path",
-        type=Path,
-        default="./downloads",
-        help="Path where downloads will be stored",
-    )
-    parser.add_argument(
-        "--data_path",
-        type=Path,
-        default="./extracted",
-        help="Path where extracted data will be stored",
-    )
-    parser.add_argument(
-        "--csv_path",
-        type=Path,
-        default="./land_value.csv",
-        help="Path to output CSV file",
-    )
-    parser.add_argument(
-        "--pdf_path", type=Path, default="./pdfs", help="Path to PDF files"
-    )
-    parser.add_argument(
-        "--manifest_file",
-        type=Path,
-        default="./manifest.txt",
-        help="A manifest of all files donwloaded, and parsed.",
-    )
-    parser.add_argument(
-        "--keep_raw_files",
-        action="store_true",
-        default=False,
-        help="Keep the raw data directories",
+def _as_yyyymmdd(value):
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y%m%d")
+    return str(value).replace("-", "")
+
+
+def _district_codes(districts):
+    return {str(district).strip().zfill(3) for district in districts}
+
+
+def record_filter(record_format, districts=None, since=None, until=None):
+    # keep(parts) for the B records of a file, on district code and contract
+    # date (inclusive).
+    if districts is None and since is None and until is None:
+        return None
+    if districts is not None:
+        districts = _district_codes(districts)
+    since = None if since is None else _as_yyyymmdd(since)
+    until = None if until is None else _as_yyyymmdd(until)
+    contract_date = RECORD_CONTRACT_DATES[record_format]
+
+    def keep(parts):
+        if districts is not None and parts[1].strip() not in districts:
+            return False
+        if since is None and until is None:
+            return True
+        value = contract_date(parts).strip()
+        return (since is None or value >= since) and (until is None or value <= until)
+
+    return keep
+
+
+NAME_DATE = re.compile(r"(?<!\d)(\d{8}|\d{4})(?!\d)")
+NAME_DISTRICT = re.compile(r"(\d{3})_SALES_DATA")
+
+
+def name_filter(districts=None, since=None):
+    # keep(name) for archives and data files, before they're downloaded or
+    # read. The last date in a name (a day, or a year for yearly archives and
+    # the 1990-2000 archive) is the latest contract date the file can hold,
+    # so it can go if that's before since. There's no skipping on until, sales
+    # are lodged some time after the contract. Weekly data files also start
+    # with their district code.
+    if districts is None and since is None:
+        return None
+    if districts is not None:
+        districts = _district_codes(districts)
+    since = None if since is None else _as_yyyymmdd(since)
+
+    def keep(name):
+        name = PurePosixPath(name).name
+        match = NAME_DISTRICT.match(name)
+        if districts is not None and match and match.group(1) not in districts:
+            return False
+        dates = NAME_DATE.findall(name)
+        if since is not None and dates:
+            last = dates[-1] if len(dates[-1]) == 8 else dates[-1] + "1231"
+            return last >= since
+        return True
+
+    return keep
+
+
+def shard_filter(shard, shards):
+    # keep(name) for the archives in the listing that belong to shard (of
+    # shards). The name is hashed, so every machine agrees on the split
+    # without seeing what the others have.
+    def keep(name):
+        name = PurePosixPath(name).name
+        digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % shards == shard
+
+    return keep
+
+
+def iter_sales(source, districts=None, since=None, until=None, dedup=False):
+    # Lazily yields Sale records from a .DAT file, a (nested) zip of them or a
+    # directory holding either. districts are district codes, since and until
+    # are dates (or YYYYMMDD / YYYY-MM-DD strings) compared against the
+    # contract date. dedup drops duplicates like the CSV conversion, at the
+    # cost of a DedupIndex entry for every sale seen.
+    filters = None
+    if districts is not None or since is not None or until is not None:
+        filters = {"districts": districts, "since": since, "until": until}
+    seen = DedupIndex() if dedup else None
+    keep = name_filter(districts, since)
+    for path, _, file in iter_source_files(source, keep):
+        if keep is not None and not keep(path):
+            continue
+        for row in handle_path(path, file, filters):
+            if seen is not None and not seen.add(row):
+                continue
+            yield Sale._make(row)
+
+
+def iter_sales_batches(source, batch_size=10000, **filters):
+    batch = []
+    for sale in iter_sales(source, **filters):
+        batch.append(sale)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+DIGEST_WORDS = struct.Struct("<QQ")
+KEYS_HEADER = struct.Struct("<8sQ")
+KEYS_MAGIC = b"NSWKEYS1"
+
+
+def row_digest(row):
+    # Fields come from single lines of the data files, so they never contain
+    # a newline and joining on one keeps distinct rows distinct.
+    return hashlib.blake2b("\n".join(row).encode(), digest_size=16).digest()
+
+
+class DedupIndex:
+    # Open addressing (linear probing) table of 128 bit row digests, stored
+    # as pairs of 64 bit words in one flat array. Unlike hash() the digest is
+    # stable across processes and runs, and at 128 bits a collision between
+    # distinct sales is not a practical concern. A zero high word marks an
+    # empty slot.
+    def __init__(self, capacity=1 << 16):
+        self._table = array("Q", [0]) * (capacity * 2)
+        self._mask = capacity - 1
+        self._limit = capacity * 3 // 4
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._table.itemsize * len(self._table)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(KEYS_HEADER.pack(KEYS_MAGIC, self._count))
+            self._table.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            magic, count = KEYS_HEADER.unpack(f.read(KEYS_HEADER.size))
+            if magic != KEYS_MAGIC:
+                raise ValueError(f"{path} is not a dedup key file")
+            table = array("Q")
+            table.frombytes(f.read())
+        index = cls(1)
+        index._table, index._count = table, count
+        index._mask = len(table) // 2 - 1
+        index._limit = len(table) // 2 * 3 // 4
+        return index
+
+    def add(self, row):
+        return self.add_digest(row_digest(row))
+
+    def add_digest(self, key):
+        high, low = DIGEST_WORDS.unpack(key)
+        high = high or 1
+        table, mask = self._table, self._mask
+        slot = high & mask
+        while True:
+            found = table[2 * slot]
+            if not found:
+                break
+            if found == high and table[2 * slot + 1] == low:
+                return False
+            slot = (slot + 1) & mask
+        table[2 * slot] = high
+        table[2 * slot + 1] = low
+        self._count += 1
+        if self._count > self._limit:
+            self._grow()
+        return True
+
+    def _grow(self):
+        # Only the old and the new table are held at once, the old one is
+        # read in place rather than sliced into copies.
+        old = self._table
+        capacity = (self._mask + 1) * 2
+        table, mask = array("Q", [0]) * (capacity * 2), capacity - 1
+        for i in range(0, len(old), 2):
+            high = old[i]
+            if not high:
+                continue
+            slot = high & mask
+            while table[2 * slot]:
+                slot = (slot + 1) & mask
+            table[2 * slot] = high
+            table[2 * slot + 1] = old[i + 1]
+        self._table, self._mask, self._limit = table, mask, capacity * 3 // 4
+
+
+def parse_rows(path, file=None, filters=None):
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    return list(handle_path(path, file, filters))
+
+
+def _timed_parse_rows(path, file=None, filters=None):
+    start = time.perf_counter()
+    rows = parse_rows(path, file, filters)
+    return rows, time.perf_counter() - start
+
+
+class ParseCache:
+    # Parsed rows of each data file, stored under a hash of its contents so
+    # renamed or re-extracted files still hit. Entries are marshalled row
+    # tuples compressed with zlib, and the least recently used ones are
+    # evicted once the cache grows past max_bytes. Recency is kept in memory
+    # while running and in the entries' mtimes (refreshed on every hit)
+    # between runs. Entries live in a directory per parser and marshal
+    # version, directories of other versions are removed on open.
+    VERSION_DIRECTORY = re.compile(r"v\d+-m\d+")
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        directory = Path(directory)
+        self.path = directory / f"v{PARSER_VERSION}-m{marshal.version}"
+        self.path.mkdir(parents=True, exist_ok=True)
+        for old in directory.iterdir():
+            if (
+                old != self.path
+                and old.is_dir()
+                and self.VERSION_DIRECTORY.fullmatch(old.name)
+            ):
+                shutil.rmtree(old)
+        self.max_bytes = max_bytes
+        entries = []
+        for entry in self.path.glob("*.rows"):
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        # Oldest first, so eviction pops from the front.
+        self.sizes = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.total = sum(self.sizes.values())
+
+    @staticmethod
+    def key(path, data, filters=None):
+        # The record format comes from the file name and filtered parses hold
+        # fewer rows, so both are part of the key.
+        record_format = record_format_for(Path(path).name)
+        digest = hashlib.blake2b(data, digest_size=16)
+        if filters is not None:
+            digest.update(json.dumps(filters, sort_keys=True, default=str).encode())
+        return f"{RECORD_FORMAT_NAMES.get(record_format, 'none')}-{digest.hexdigest()}"
+
+    def get(self, key):
+        entry = self.path / f"{key}.rows"
+        try:
+            data = entry.read_bytes()
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        if entry.name in self.sizes:
+            self.sizes.move_to_end(entry.name)
+        try:
+            return marshal.loads(zlib.decompress(data))
+        except (zlib.error, EOFError, ValueError, TypeError):
+            self._remove(entry.name)
+            return None
+
+    def put(self, key, rows):
+        data = zlib.compress(marshal.dumps(rows), 1)
+        if len(data) > self.max_bytes:
+            return
+        entry = self.path / f"{key}.rows"
+        # Processes sharing the cache can put the same entry at once, each
+        # writes its own temporary file.
+        fd, temp = tempfile.mkstemp(prefix=f"{key}.", suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, entry)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp)
+            raise
+        self.total += len(data) - self.sizes.pop(entry.name, 0)
+        self.sizes[entry.name] = len(data)
+        self._evict()
+
+    def _remove(self, name):
+        with contextlib.suppress(FileNotFoundError):
+            (self.path / name).unlink()
+        self.total -= self.sizes.pop(name, 0)
+
+    def _evict(self):
+        while self.total > self.max_bytes and self.sizes:
+            self._remove(next(iter(self.sizes)))
+            METRICS.count("parse_cache_evictions")
+
+
+def _cache_lookup(cache, path, file, filters=None):
+    data = Path(path).read_bytes() if file is None else file.read()
+    key = cache.key(path, data, filters)
+    rows = cache.get(key)
+    METRICS.count("parse_cache_misses" if rows is None else "parse_cache_hits")
+    return data, key, rows
+
+
+def iter_parsed(sources, workers=None, cache=None, filters=None):
+    if not workers:
+        for path, size, file in sources:
+            if cache is None:
+                yield (path, size, *_timed_parse_rows(path, file, filters))
+                continue
+            data, key, rows = _cache_lookup(cache, path, file, filters)
+            if rows is not None:
+                yield path, size, rows, 0.0
+                continue
+            rows, seconds = _timed_parse_rows(path, data, filters)
+            cache.put(key, rows)
+            yield path, size, rows, seconds
+        return
+    # Results are collected in submission order, and only a couple of files
+    # per worker are in flight so finished batches don't pile up in memory.
+    # Workers aren't forked, the pipeline's download and extract threads are
+    # running by now and forking a threaded process can deadlock the child.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
     )
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        pending = deque()
+        for path, size, file in sources:
+            key = rows = None
+            if cache is None:
+                data = None if file is None else file.read()
+            else:
+                data, key, rows = _cache_lookup(cache, path, file, filters)
+            if rows is None:
+                result = executor.submit(_timed_parse_rows, path, data, filters)
+            else:
+                result = (rows, 0.0)
+            pending.append((path, size, key, result))
+            if len(pending) >= 2 * workers:
+                yield _parsed_result(cache, *pending.popleft())
+        for item in pending:
+            yield _parsed_result(cache, *item)
 
-    args = parser.parse_args()
-    args.download_path.mkdir(parents=True, exist_ok=True)
-    args.data_path.mkdir(parents=True, exist_ok=True)
-    args.pdf_path.mkdir(parents=True, exist_ok=True)
 
+def _parsed_result(cache, path, size, key, result):
+    if isinstance(result, tuple):
+        return (path, size, *result)
+    rows, seconds = result.result()
+    if cache is not None:
+        cache.put(key, rows)
+    return path, size, rows, seconds
+
+
+CATEGORICAL_COLUMNS = (
+    "district_code",
+    "district_name",
+    "area_type",
+    "zone_code",
+    "zone_name",
+    "nature_property",
+    "primary_purpose",
+    "component_code",
+    "sale_code",
+    "filetype",
+)
+
+
+class Output:
+    # Outputs that drop duplicate rows themselves are handed every row.
+    dedups = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvOutput(Output):
+    def __init__(self, out_path, append=False, on_rows=None, columns=None):
+        self._file = open(out_path, "a" if append else "w", newline="")
+        self._writer = csv.writer(self._file)
+        # Only these columns are written, rows still come in with all of them.
+        self._indexes = None
+        if columns is not None:
+            self._indexes = [COLUMNS.index(column) for column in columns]
+        if not append:
+            self._writer.writerow(COLUMNS if columns is None else columns)
+        # on_rows(rows, offsets) is told the byte offset each row starts at.
+        self._on_rows = on_rows
+        if on_rows is not None:
+            self._file.flush()
+            self._offset = os.path.getsize(out_path)
+            self._buffer = io.StringIO()
+            self._buffer_writer = csv.writer(self._buffer)
+
+    def write_rows(self, rows):
+        if self._indexes is not None:
+            indexes = self._indexes
+            rows = [[row[i] for i in indexes] for row in rows]
+        if self._on_rows is None:
+            self._writer.writerows(rows)
+            return
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        starts = []
+        for row in rows:
+            starts.append(self._buffer.tell())
+            self._buffer_writer.writerow(row)
+        text = self._buffer.getvalue()
+        data = text.encode(self._file.encoding)
+        if len(data) != len(text):
+            # Not plain ASCII, so character positions need converting.
+            position = previous = 0
+            byte_starts = []
+            for start in starts:
+                position += len(text[previous:start].encode(self._file.encoding))
+                byte_starts.append(position)
+                previous = start
+            starts = byte_starts
+        offsets = [self._offset + start for start in starts]
+        self._file.write(text)
+        self._offset += len(data)
+        self._on_rows(rows, offsets)
+
+    def close(self):
+        self._file.close()
+
+
+def _to_int(value):
     try:
-        when = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _to_date(value):
+    # Both file formats end up with dates as YYYYMMDD.
+    try:
+        return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    except ValueError:
+        return None
+
+
+class ParquetOutput(Output):
+    def __init__(self, out_path, row_group_size=250_000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet output requires pyarrow to be installed") from e
+        self._pa = pa
+        fields = []
+        for column in COLUMNS:
+            if column == "purchase_price":
+                fields.append(pa.field(column, pa.int64()))
+            elif column == "area":
+                fields.append(pa.field(column, pa.float64()))
+            elif column in ("contract_date", "settlement_date"):
+                fields.append(pa.field(column, pa.date32()))
+            elif column in CATEGORICAL_COLUMNS:
+                fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+            else:
+                fields.append(pa.field(column, pa.string()))
+        self._schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(out_path, self._schema)
+        self._row_group_size = row_group_size
+        self._rows = []
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        pa = self._pa
+        columns = list(zip(*self._rows))
+        arrays = []
+        for field, values in zip(self._schema, columns):
+            if field.name == "purchase_price":
+                arrays.append(pa.array(map(_to_int, values), field.type))
+            elif field.name == "area":
+                arrays.append(pa.array(map(_to_float, values), field.type))
+            elif field.type == pa.date32():
+                arrays.append(pa.array(map(_to_date, values), field.type))
+            elif field.name in CATEGORICAL_COLUMNS:
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, pa.string()))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        self._writer.close()
+
+
+def _partition_year(row):
+    for column in ("settlement_date", "contract_date"):
+        year = row[COLUMNS.index(column)].strip()[:4]
+        if year.isdigit():
+            return year
+    return "unknown"
+
+
+class PartitionedOutput(Output):
+    # One CSV per district_code=XXX/year=YYYY directory. Only the most
+    # recently used partitions are kept open, the rest are reopened for
+    # appending when more of their rows turn up.
+    def __init__(self, out_path, max_open_files=64):
+        self._base = Path(out_path)
+        self._base.mkdir(parents=True, exist_ok=True)
+        for old in self._base.glob("district_code=*"):
+            shutil.rmtree(old)
+        self._max_open_files = max_open_files
+        self._open = OrderedDict()
+        self._rows = {}
+
+    def _writer(self, key):
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key][1]
+        if len(self._open) >= self._max_open_files:
+            _, (old_file, _) = self._open.popitem(last=False)
+            old_file.close()
+        path = self._partition_path(key)
+        new = key not in self._rows
+        if new:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._rows[key] = 0
+        partition_file = open(path, "w" if new else "a", newline="")
+        writer = csv.writer(partition_file)
+        if new:
+            writer.writerow(COLUMNS)
+        self._open[key] = (partition_file, writer)
+        return writer
+
+    def _partition_path(self, key):
+        district_code, year = key
+        return self._base / f"district_code={district_code}" / f"year={year}" / "part-0.csv"
+
+    def write_rows(self, rows):
+        district = COLUMNS.index("district_code")
+        for row in rows:
+            key = (row[district].strip() or "unknown", _partition_year(row))
+            self._writer(key).writerow(row)
+            self._rows[key] += 1
+
+    def close(self):
+        for partition_file, _ in self._open.values():
+            partition_file.close()
+        self._open.clear()
+        partitions = []
+        for key, rows in sorted(self._rows.items()):
+            path = self._partition_path(key)
+            partitions.append(
+                {
+                    "path": str(path.relative_to(self._base)),
+                    "district_code": key[0],
+                    "year": key[1],
+                    "rows": rows,
+                    "bytes": path.stat().st_size,
+                }
+            )
+        with open(self._base / "_partitions.json", "w") as f:
+            json.dump({"columns": COLUMNS, "partitions": partitions}, f, indent=1)
+
+
+SQLITE_TYPES = {"purchase_price": "INTEGER", "area": "REAL"}
+
+SQLITE_INDEXES = {
+    "sales_property_id": ("property_id",),
+    "sales_address": (
+        "property_locality",
+        "property_street_name",
+        "property_house_number",
+    ),
+    "sales_district_code": ("district_code",),
+    "sales_settlement_date": ("settlement_date",),
+}
+
+
+class SqliteOutput(Output):
+    # Rows are inserted in large transactions into an unindexed table, the
+    # indexes are built once at the end which is much cheaper than keeping
+    # them up to date row by row.
+    def __init__(self, out_path, batch_size=200_000):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(f"{out_path}{suffix}"):
+                os.remove(f"{out_path}{suffix}")
+        self._db = sqlite3.connect(out_path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("PRAGMA cache_size=-262144")
+        columns = ", ".join(
+            f"{column} {SQLITE_TYPES.get(column, 'TEXT')}" for column in COLUMNS
+        )
+        self._db.execute(f"CREATE TABLE sales ({columns})")
+        placeholders = ", ".join("?" * len(COLUMNS))
+        self._insert = f"INSERT INTO sales VALUES ({placeholders})"
+        self._batch_size = batch_size
+        self._rows = []
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        self._db.execute("BEGIN")
+        self._db.executemany(self._insert, self._rows)
+        self._db.execute("COMMIT")
+        self._rows = []
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        for name, columns in SQLITE_INDEXES.items():
+            self._db.execute(f"CREATE INDEX {name} ON sales ({', '.join(columns)})")
+        self._db.execute("ANALYZE")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._db.close()
+
+
+def query_sales(db_path, property_id=None, locality=None, street_name=None,
+                house_number=None, districts=None, since=None, until=None,
+                limit=None):
+    conditions, params = [], []
+    if property_id is not None:
+        conditions.append("property_id = ?")
+        params.append(str(property_id))
+    for column, value in (
+        ("property_locality", locality),
+        ("property_street_name", street_name),
+        ("property_house_number", house_number),
+    ):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(str(value).strip().upper())
+    if districts is not None:
+        districts = [str(district).strip().zfill(3) for district in districts]
+        conditions.append(f"district_code IN ({', '.join('?' * len(districts))})")
+        params.extend(districts)
+    if since is not None:
+        conditions.append("settlement_date >= ?")
+        params.append(_as_yyyymmdd(since))
+    if until is not None:
+        conditions.append("settlement_date <= ?")
+        params.append(_as_yyyymmdd(until))
+    sql = "SELECT * FROM sales"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY settlement_date, rowid"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for row in db.execute(sql, params):
+            yield Sale(*row)
+    finally:
+        db.close()
+
+
+ROW_INDEX_HEADER = struct.Struct("<8sQ")
+ROW_INDEX_MAGIC = b"NSWIDX02"
+ROW_INDEX_ENTRY = struct.Struct("<QQ")
+
+
+# Street types are abbreviated the way the data files do, so "SMITH STREET"
+# and "SMITH ST" look up, index and search the same.
+STREET_TYPES = {
+    "ALLEY": "ALLY",
+    "ARCADE": "ARC",
+    "AVENUE": "AVE",
+    "BOULEVARD": "BVD",
+    "CIRCUIT": "CCT",
+    "CLOSE": "CL",
+    "COURT": "CT",
+    "CRESCENT": "CRES",
+    "DRIVE": "DR",
+    "ESPLANADE": "ESP",
+    "GROVE": "GR",
+    "HIGHWAY": "HWY",
+    "LANE": "LANE",
+    "PARADE": "PDE",
+    "PARKWAY": "PWY",
+    "PLACE": "PL",
+    "ROAD": "RD",
+    "SQUARE": "SQ",
+    "STREET": "ST",
+    "TERRACE": "TCE",
+}
+
+
+def _address_words(address):
+    words = re.sub(r"[^\w/]+", " ", address.upper()).split()
+    return [STREET_TYPES.get(word, word) for word in words]
+
+
+def _normalize_address(address):
+    return " ".join(_address_words(address))
+
+
+def row_address(row):
+    unit = row[COLUMNS.index("property_unit_number")].strip()
+    house = row[COLUMNS.index("property_house_number")].strip()
+    number = f"{unit}/{house}" if unit else house
+    street = row[COLUMNS.index("property_street_name")]
+    locality = row[COLUMNS.index("property_locality")]
+    return _normalize_address(f"{number} {street} {locality}")
+
+
+def _index_key(kind, value):
+    digest = hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _row_keys(row):
+    keys = []
+    property_id = row[COLUMNS.index("property_id")].strip()
+    if property_id:
+        keys.append(_index_key("property_id", property_id))
+    address = row_address(row)
+    if address:
+        keys.append(_index_key("address", address))
+    return keys
+
+
+def _read_index_header(f, path):
+    magic, count = ROW_INDEX_HEADER.unpack(f.read(ROW_INDEX_HEADER.size))
+    if magic != ROW_INDEX_MAGIC:
+        raise ValueError(f"{path} is not a row index")
+    return count
+
+
+def _read_index_entries(f, count, chunk=65536):
+    while count:
+        data = f.read(ROW_INDEX_ENTRY.size * min(count, chunk))
+        if not data:
+            break
+        count -= len(data) // ROW_INDEX_ENTRY.size
+        yield from ROW_INDEX_ENTRY.iter_unpack(data)
+
+
+class RowIndexWriter:
+    # (key hash, byte offset) pairs for every row, sorted so lookups can
+    # binary search the file. Pairs are sorted and spilled to disk in runs
+    # that are merged at the end, so memory use doesn't grow with the output.
+    def __init__(self, index_path, spill_entries=1_000_000, merge_existing=False):
+        self._index_path = Path(index_path)
+        self._spill_entries = spill_entries
+        self._entries = array("Q")
+        self._runs = []
+        self._run_dir = None
+        self._existing = merge_existing and self._index_path.exists()
+
+    def add_rows(self, rows, offsets):
+        for row, offset in zip(rows, offsets):
+            for key in _row_keys(row):
+                self._entries.append(key)
+                self._entries.append(offset)
+        if len(self._entries) >= 2 * self._spill_entries:
+            self._spill()
+
+    def _spill(self):
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(
+                prefix=".index-", dir=self._index_path.parent
+            )
+        pairs = sorted(zip(self._entries[::2], self._entries[1::2]))
+        run = array("Q", itertools.chain.from_iterable(pairs))
+        run_path = os.path.join(self._run_dir, f"run-{len(self._runs)}")
+        with open(run_path, "wb") as f:
+            run.tofile(f)
+        self._runs.append((run_path, len(pairs)))
+        self._entries = array("Q")
+
+    def close(self):
+        if self._entries:
+            self._spill()
+        with contextlib.ExitStack() as stack:
+            sources = []
+            if self._existing:
+                f = stack.enter_context(open(self._index_path, "rb"))
+                count = _read_index_header(f, self._index_path)
+                sources.append(_read_index_entries(f, count))
+            for run_path, count in self._runs:
+                f = stack.enter_context(open(run_path, "rb"))
+                sources.append(_read_index_entries(f, count))
+            part_path = f"{self._index_path}.part"
+            count = 0
+            with open(part_path, "wb") as out:
+                out.write(ROW_INDEX_HEADER.pack(ROW_INDEX_MAGIC, 0))
+                chunk = array("Q")
+                for key, offset in heapq.merge(*sources):
+                    chunk.append(key)
+                    chunk.append(offset)
+                    if len(chunk) >= 131072:
+                        chunk.tofile(out)
+                        count += len(chunk) // 2
+                        chunk = array("Q")
+                chunk.tofile(out)
+                count += len(chunk) // 2
+                out.seek(0)
+                out.write(ROW_INDEX_HEADER.pack(ROW_INDEX_MAGIC, count))
+        os.replace(part_path, self._index_path)
+        self.discard()
+
+    def discard(self):
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir)
+            self._run_dir = None
+        self._runs = []
+
+
+def _index_offsets(index_path, key):
+    with open(index_path, "rb") as f:
+        count = _read_index_header(f, index_path)
+        if not count:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            def entry(i):
+                return ROW_INDEX_ENTRY.unpack_from(
+                    view, ROW_INDEX_HEADER.size + i * ROW_INDEX_ENTRY.size
+                )
+
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if entry(middle)[0] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            offsets = []
+            while low < count:
+                found, offset = entry(low)
+                if found != key:
+                    break
+                offsets.append(offset)
+                low += 1
+            return offsets
+
+
+def _read_record(f):
+    data = f.readline()
+    # Quoted fields can contain line breaks, keep reading until they close.
+    while data.count(b'"') % 2:
+        line = f.readline()
+        if not line:
+            break
+        data += line
+    return data
+
+
+def _read_row_at(f, offset, encoding):
+    f.seek(offset)
+    return tuple(next(csv.reader([_read_record(f).decode(encoding)])))
+
+
+def _iter_csv_rows(f, encoding):
+    # (offset, row) for every record from the start of the file, header
+    # included.
+    offset = 0
+    while True:
+        data = _read_record(f)
+        if not data:
+            return
+        yield offset, tuple(next(csv.reader([data.decode(encoding)])))
+        offset += len(data)
+
+
+def index_existing_rows(row_index, csv_path, batch_size=10000):
+    encoding = locale.getpreferredencoding(False)
+    with open(csv_path, "rb") as f:
+        records = _iter_csv_rows(f, encoding)
+        next(records, None)
+        rows, offsets = [], []
+        for offset, row in records:
+            rows.append(row)
+            offsets.append(offset)
+            if len(rows) >= batch_size:
+                row_index.add_rows(rows, offsets)
+                rows, offsets = [], []
+        row_index.add_rows(rows, offsets)
+
+
+def lookup_sales(csv_path, property_id=None, address=None, index_path=None):
+    if (property_id is None) == (address is None):
+        raise ValueError("Look up either a property_id or an address")
+    index_path = f"{csv_path}.idx" if index_path is None else index_path
+    if property_id is not None:
+        value = str(property_id).strip()
+        key = _index_key("property_id", value)
+
+        def matches(row):
+            return row[COLUMNS.index("property_id")].strip() == value
+    else:
+        value = _normalize_address(address)
+        key = _index_key("address", value)
+
+        def matches(row):
+            return row_address(row) == value
+
+    encoding = locale.getpreferredencoding(False)
+    with open(csv_path, "rb") as f:
+        for offset in _index_offsets(index_path, key):
+            row = _read_row_at(f, offset, encoding)
+            # Different keys can share a hash, so every row is checked.
+            if matches(row):
+                yield Sale(*row)
+
+
+ADDRESS_INDEX_HEADER = struct.Struct("<8sQQQ")
+ADDRESS_INDEX_MAGIC = b"NSWADR01"
+# Per term: offset and length of its text, offset and count of its postings.
+ADDRESS_INDEX_TERM = struct.Struct("<QIQI")
+FUZZY_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def address_tokens(unit, house, street, locality):
+    # Unit numbers are kept apart from house numbers with a trailing slash,
+    # the way they are written ("1/165" is unit 1 of number 165).
+    tokens = [part + "/" for part in re.findall(r"\w+", unit.upper())]
+    tokens += re.findall(r"\w+", house.upper())
+    tokens += _address_words(f"{street} {locality}".replace("/", " "))
+    return tokens
+
+
+def query_tokens(query):
+    tokens = []
+    for word in re.findall(r"[\w/]+", query.upper()):
+        if "/" in word:
+            unit, _, word = word.partition("/")
+            tokens += [part + "/" for part in re.findall(r"\w+", unit)]
+        tokens += _address_words(word.replace("/", " "))
+    return tokens
+
+
+ADDRESS_RUN_ENTRY = struct.Struct("<IH")
+
+
+def _spill_address_run(pairs, run_dir, runs):
+    run_path = os.path.join(run_dir, f"run-{len(runs)}")
+    pack = ADDRESS_RUN_ENTRY.pack
+    with open(run_path, "wb") as f:
+        f.writelines(pack(row_id, len(text)) + text for text, row_id in sorted(pairs))
+    runs.append(run_path)
+
+
+def _read_address_run(f):
+    f = io.BufferedReader(f, 1 << 16)
+    while True:
+        entry = f.read(ADDRESS_RUN_ENTRY.size)
+        if not entry:
+            return
+        row_id, length = ADDRESS_RUN_ENTRY.unpack(entry)
+        yield f.read(length), row_id
+
+
+def build_address_index(csv_path, index_path=None, spill_entries=1_000_000):
+    # Postings (row ids, ascending) for every address token of the CSV, and
+    # the byte offset of every row so results are read without a scan. The
+    # whole file is laid out for mmap: header, row offsets, the term table
+    # sorted by term, the term texts and the postings. (term, row id) pairs
+    # are sorted and spilled to disk in runs like RowIndexWriter's, and each
+    # section goes to its own temporary file while the runs are merged, so
+    # memory use doesn't grow with the CSV.
+    index_path = Path(f"{csv_path}.adr" if index_path is None else index_path)
+    encoding = locale.getpreferredencoding(False)
+    run_dir = tempfile.mkdtemp(prefix=".address-", dir=index_path.parent)
+    try:
+        rows = 0
+        runs = []
+        pairs = []
+        offsets = array("Q")
+        offsets_path = os.path.join(run_dir, "offsets")
+        with open(csv_path, "rb") as f, open(offsets_path, "wb") as offsets_file:
+            records = _iter_csv_rows(f, encoding)
+            _, header = next(records, (0, ()))
+            names = ("property_unit_number", "property_house_number",
+                     "property_street_name", "property_locality")
+            missing = [name for name in names if name not in header]
+            if missing:
+                raise ValueError(f"{csv_path} has no {', '.join(missing)} column")
+            columns = [header.index(name) for name in names]
+            for offset, row in records:
+                offsets.append(offset)
+                for token in set(address_tokens(*(row[i] for i in columns))):
+                    pairs.append((token.encode(), rows))
+                rows += 1
+                if len(offsets) >= 131072:
+                    offsets.tofile(offsets_file)
+                    offsets = array("Q")
+                if len(pairs) >= spill_entries:
+                    _spill_address_run(pairs, run_dir, runs)
+                    pairs = []
+            offsets.tofile(offsets_file)
+        if pairs:
+            _spill_address_run(pairs, run_dir, runs)
+            pairs = []
+        terms = text_offset = posting_offset = 0
+        sections = [os.path.join(run_dir, name) for name in ("terms", "texts", "postings")]
+        with contextlib.ExitStack() as stack:
+            sources = [
+                _read_address_run(stack.enter_context(open(run_path, "rb")))
+                for run_path in runs
+            ]
+            table, texts, postings = (
+                stack.enter_context(open(path, "wb")) for path in sections
+            )
+            current, start = None, 0
+            posting = array("I")
+            for text, row_id in heapq.merge(*sources):
+                if text != current:
+                    if current is not None:
+                        table.write(ADDRESS_INDEX_TERM.pack(
+                            text_offset, len(current), start, posting_offset - start
+                        ))
+                        texts.write(current)
+                        text_offset += len(current)
+                        terms += 1
+                    current, start = text, posting_offset
+                posting.append(row_id)
+                posting_offset += 1
+                if len(posting) >= 131072:
+                    posting.tofile(postings)
+                    posting = array("I")
+            if current is not None:
+                table.write(ADDRESS_INDEX_TERM.pack(
+                    text_offset, len(current), start, posting_offset - start
+                ))
+                texts.write(current)
+                text_offset += len(current)
+                terms += 1
+            posting.tofile(postings)
+        temp_path = index_path.with_name(index_path.name + ".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(ADDRESS_INDEX_HEADER.pack(
+                ADDRESS_INDEX_MAGIC, rows, terms, text_offset
+            ))
+            for path in (offsets_path, *sections):
+                with open(path, "rb") as section:
+                    shutil.copyfileobj(section, f, 1 << 20)
+        os.replace(temp_path, index_path)
+    finally:
+        shutil.rmtree(run_dir)
+    return index_path
+
+
+class AddressIndex:
+    # Read side of build_address_index, straight from an mmap of the file.
+    def __init__(self, index_path):
+        self.path = Path(index_path)
+        self._file = open(self.path, "rb")
+        header = self._file.read(ADDRESS_INDEX_HEADER.size)
+        if len(header) != ADDRESS_INDEX_HEADER.size:
+            raise ValueError(f"{self.path} is not an address index")
+        magic, self.rows, self.terms, texts = ADDRESS_INDEX_HEADER.unpack(header)
+        if magic != ADDRESS_INDEX_MAGIC:
+            raise ValueError(f"{self.path} is not an address index")
+        self._view = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = ADDRESS_INDEX_HEADER.size
+        self._term_table = self._offsets + 8 * self.rows
+        self._texts = self._term_table + ADDRESS_INDEX_TERM.size * self.terms
+        self._postings = self._texts + texts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._view.close()
+        self._file.close()
+
+    def offset(self, row_id):
+        return struct.unpack_from("<Q", self._view, self._offsets + 8 * row_id)[0]
+
+    def _term(self, i):
+        return ADDRESS_INDEX_TERM.unpack_from(
+            self._view, self._term_table + i * ADDRESS_INDEX_TERM.size
+        )
+
+    def _text(self, i):
+        text_offset, length, _, _ = self._term(i)
+        start = self._texts + text_offset
+        return self._view[start : start + length]
+
+    def _bisect(self, text):
+        low, high = 0, self.terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._text(middle) < text:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def postings(self, i):
+        _, _, posting_offset, count = self._term(i)
+        start = self._postings + 4 * posting_offset
+        return memoryview(self._view)[start : start + 4 * count].cast("I")
+
+    def find(self, token, prefix=False):
+        # Term numbers of token, or of every term starting with it.
+        text = token.encode()
+        start = self._bisect(text)
+        if not prefix:
+            found = start < self.terms and self._text(start) == text
+            return [start] if found else []
+        # No UTF-8 text contains 0xFF, so this sorts after every extension.
+        return list(range(start, self._bisect(text + b"\xff")))
+
+    def find_fuzzy(self, token, prefix=False):
+        # Terms one deletion, insertion, substitution or transposition away
+        # (of the typed part, when it's a prefix). Only tried for words,
+        # a mistyped number is just another number.
+        variants = set()
+        for i in range(len(token) + 1):
+            head, tail = token[:i], token[i:]
+            if tail:
+                variants.add(head + tail[1:])
+                if len(tail) > 1:
+                    variants.add(head + tail[1] + tail[0] + tail[2:])
+            for letter in FUZZY_ALPHABET:
+                variants.add(head + letter + tail)
+                if tail:
+                    variants.add(head + letter + tail[1:])
+        variants.discard(token)
+        terms = set()
+        for variant in variants:
+            if variant:
+                terms.update(self.find(variant, prefix))
+        return sorted(terms)
+
+    def search(self, query, limit=None):
+        # Row ids (ascending) of the rows holding every token of the query.
+        # The last token may be partly typed unless the query ends in a
+        # space, and words that match nothing are retried with one typo.
+        tokens = query_tokens(query)
+        if not tokens:
+            return []
+        groups = []
+        for position, token in enumerate(tokens):
+            prefix = position == len(tokens) - 1 and not query[-1:].isspace()
+            terms = self.find(token, prefix)
+            if not terms and len(token) > 3 and token.isalpha():
+                terms = self.find_fuzzy(token, prefix)
+            if not terms:
+                return []
+            postings = [self.postings(term) for term in terms]
+            groups.append((sum(len(posting) for posting in postings), postings))
+        groups.sort(key=lambda group: group[0])
+        found = set()
+        for posting in groups[0][1]:
+            found.update(posting)
+        for total, postings in groups[1:]:
+            if not found:
+                break
+            if len(found) * len(postings) * 32 < total:
+                # Few candidates, look each one up in the (sorted) postings.
+                found = {
+                    row_id
+                    for row_id in found
+                    if any(_sorted_contains(posting, row_id) for posting in postings)
+                }
+            else:
+                found = {
+                    row_id
+                    for posting in postings
+                    for row_id in posting
+                    if row_id in found
+                }
+        row_ids = sorted(found)
+        return row_ids if limit is None else row_ids[:limit]
+
+
+def _sorted_contains(values, value):
+    i = bisect.bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+def search_addresses(csv_path, query, limit=20, index_path=None):
+    # Sales whose address holds every word of the query, e.g. "12 SMITH ST
+    # PADD", in CSV order.
+    index_path = f"{csv_path}.adr" if index_path is None else index_path
+    encoding = locale.getpreferredencoding(False)
+    with AddressIndex(index_path) as index, open(csv_path, "rb") as f:
+        for row_id in index.search(query, limit):
+            yield Sale(*_read_row_at(f, index.offset(row_id), encoding))
+
+
+BLOCK_COMPRESSORS = {
+    "gzip": lambda data: gzip.compress(data, mtime=0),
+    "xz": lzma.compress,
+}
+BLOCK_DECOMPRESSORS = {"gzip": gzip.decompress, "xz": lzma.decompress}
+
+
+class BlockCompressedOutput(Output):
+    # The CSV cut into blocks of whole rows, each compressed on its own (a
+    # gzip member or an xz stream) so the file as a whole still reads with
+    # zcat/xzcat, gzip.open or lzma.open. Blocks are compressed in a thread
+    # pool while parsing carries on, and out_path.blocks.json records where
+    # each block is, which rows it holds and their districts.
+    def __init__(self, out_path, compression="gzip", block_size=1 << 20,
+                 threads=None):
+        if compression not in BLOCK_COMPRESSORS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self._out_path = out_path
+        self._compression = compression
+        self._block_size = block_size
+        self._encoding = locale.getpreferredencoding(False)
+        threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(threads)
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._blocks = []
+        self._file = open(out_path, "wb")
+        self._offset = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._rows = self._first_row = 0
+        self._districts = set()
+        # The header is a block of its own, so every other block is only rows.
+        self._writer.writerow(COLUMNS)
+        self._cut()
+
+    def write_rows(self, rows, check_every=512):
+        district = COLUMNS.index("district_code")
+        for start in range(0, len(rows), check_every):
+            batch = rows[start : start + check_every]
+            self._writer.writerows(batch)
+            self._rows += len(batch)
+            self._districts.update(row[district].strip() for row in batch)
+            if self._buffer.tell() >= self._block_size:
+                self._cut()
+
+    def _cut(self):
+        data = self._buffer.getvalue().encode(self._encoding)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        block = {
+            "first_row": self._first_row,
+            "rows": self._rows,
+            "districts": sorted(self._districts),
+            "uncompressed": len(data),
+        }
+        self._first_row += self._rows
+        self._rows = 0
+        self._districts = set()
+        compress = BLOCK_COMPRESSORS[self._compression]
+        self._pending.append((block, self._executor.submit(compress, data)))
+        while len(self._pending) > self._max_pending:
+            self._write_block()
+
+    def _write_block(self):
+        block, future = self._pending.popleft()
+        data = future.result()
+        block["offset"], block["length"] = self._offset, len(data)
+        self._file.write(data)
+        self._offset += len(data)
+        self._blocks.append(block)
+
+    def close(self):
+        try:
+            if self._rows:
+                self._cut()
+            while self._pending:
+                self._write_block()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+        with open(f"{self._out_path}.blocks.json", "w") as f:
+            json.dump(
+                {
+                    "compression": self._compression,
+                    "encoding": self._encoding,
+                    "columns": COLUMNS,
+                    "rows": self._first_row,
+                    "blocks": self._blocks,
+                },
+                f,
+                indent=1,
+            )
+
+
+def load_block_index(path):
+    with open(f"{path}.blocks.json") as f:
+        return json.load(f)
+
+
+def read_block(f, block, index):
+    f.seek(block["offset"])
+    data = BLOCK_DECOMPRESSORS[index["compression"]](f.read(block["length"]))
+    return csv.reader(io.StringIO(data.decode(index["encoding"]), newline=""))
+
+
+def iter_block_rows(path, start=0, stop=None, districts=None):
+    # Rows start..stop (numbered from 0, not counting the header) of a block
+    # compressed CSV, optionally only those of some districts. Only the blocks
+    # that can hold them are read and decompressed.
+    index = load_block_index(path)
+    if districts is not None:
+        districts = {str(district).strip().zfill(3) for district in districts}
+    district = COLUMNS.index("district_code")
+    with open(path, "rb") as f:
+        for block in index["blocks"]:
+            first, end = block["first_row"], block["first_row"] + block["rows"]
+            if not block["rows"] or end <= start:
+                continue
+            if stop is not None and first >= stop:
+                break
+            if districts is not None and districts.isdisjoint(block["districts"]):
+                continue
+            for number, row in enumerate(read_block(f, block, index), first):
+                if number < start or (stop is not None and number >= stop):
+                    continue
+                if districts is None or row[district].strip() in districts:
+                    yield Sale(*row)
+
+
+# Rough in-memory size of a row beyond the characters of its values: the
+# tuple and a str object per column.
+ROW_OVERHEAD = sys.getsizeof(("",) * len(COLUMNS)) + len(COLUMNS) * sys.getsizeof("")
+
+
+def _unique_rows(rows):
+    # Duplicates are adjacent once sorted.
+    previous = None
+    for row in rows:
+        if row != previous:
+            yield row
+            previous = row
+
+
+class SortedCsvOutput(Output):
+    # External merge sort: rows are buffered up to memory_limit (estimated),
+    # sorted and spilled to a temporary CSV run next to the output, and the
+    # runs are k-way merged into the output on close, at most merge_width at
+    # a time. Ties on sort_by are broken by the whole row so identical rows
+    # end up next to each other and are dropped while merging, no dedup
+    # index is needed.
+    dedups = True
+
+    def __init__(self, out_path, sort_by, memory_limit=512 << 20, columns=None,
+                 merge_width=64):
+        self._out_path = Path(out_path)
+        indexes = [COLUMNS.index(column) for column in sort_by]
+        self._key = lambda row: (tuple([row[i] for i in indexes]), row)
+        self._columns = columns
+        self._memory_limit = memory_limit
+        self._merge_width = merge_width
+        self._temp = tempfile.TemporaryDirectory(
+            prefix=f".{self._out_path.name}.runs-", dir=self._out_path.parent
+        )
+        self._rows, self._size = [], 0
+        self._runs = []
+        self._spilled = self.received = self.rows = 0
+
+    def write_rows(self, rows):
+        self.received += len(rows)
+        for row in rows:
+            self._size += ROW_OVERHEAD + sum(map(len, row))
+        self._rows.extend(rows)
+        if self._size >= self._memory_limit:
+            self._rows.sort(key=self._key)
+            self._runs.append(self._write_run(self._rows))
+            self._rows, self._size = [], 0
+
+    def _write_run(self, rows):
+        path = Path(self._temp.name) / f"run-{self._spilled}.csv"
+        with open(path, "w", newline="") as f:
+            csv.writer(f).writerows(_unique_rows(rows))
+        self._spilled += 1
+        METRICS.count("sort_runs")
+        return path
+
+    def _merged(self, runs, stack):
+        readers = [
+            map(tuple, csv.reader(stack.enter_context(open(run, newline=""))))
+            for run in runs
+        ]
+        return heapq.merge(*readers, key=self._key)
+
+    def close(self):
+        try:
+            self._rows.sort(key=self._key)
+            # Merge the oldest runs into one until the rest can be opened at
+            # once.
+            while len(self._runs) >= self._merge_width:
+                runs = self._runs[: self._merge_width]
+                with contextlib.ExitStack() as stack:
+                    merged = self._write_run(self._merged(runs, stack))
+                for run in runs:
+                    run.unlink()
+                self._runs = self._runs[self._merge_width :] + [merged]
+            with contextlib.ExitStack() as stack:
+                rows = heapq.merge(
+                    self._rows, self._merged(self._runs, stack), key=self._key
+                )
+                self._rows = []
+                with CsvOutput(self._out_path, columns=self._columns) as output:
+                    batch = []
+                    for row in _unique_rows(rows):
+                        batch.append(row)
+                        if len(batch) == 10000:
+                            output.write_rows(batch)
+                            self.rows += len(batch)
+                            batch = []
+                    output.write_rows(batch)
+                    self.rows += len(batch)
+            METRICS.count("duplicates", self.received - self.rows)
+            METRICS.count("rows_written", self.rows)
+            print(f"Sorted {self.rows} unique sales ({self._spilled} runs spilled).")
+        finally:
+            self._temp.cleanup()
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._temp.cleanup()
+
+
+def open_output(out_path, output_format="csv", partition=False, append=False,
+                on_rows=None, compression=None, columns=None, sort_by=None,
+                sort_memory=512 << 20):
+    if sort_by is not None:
+        if output_format != "csv" or partition or append or on_rows is not None:
+            raise ValueError(
+                "Sorting is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+        if compression is not None:
+            raise ValueError("Sorting is not supported with compression")
+        return SortedCsvOutput(out_path, sort_by, sort_memory, columns)
+    if columns is not None:
+        if output_format != "csv" or partition or append or on_rows is not None:
+            raise ValueError(
+                "Column selection is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+        if compression is not None:
+            raise ValueError("Column selection is not supported with compression")
+    if compression is not None:
+        if output_format != "csv" or partition or append or on_rows is not None:
+            raise ValueError(
+                "Compression is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+        return BlockCompressedOutput(out_path, compression)
+    if partition:
+        if output_format != "csv":
+            raise ValueError("Partitioned output is only supported for CSV")
+        return PartitionedOutput(out_path)
+    if output_format == "parquet":
+        return ParquetOutput(out_path)
+    if output_format == "sqlite":
+        return SqliteOutput(out_path)
+    return CsvOutput(out_path, append, on_rows, columns)
+
+
+class QuantileSketch:
+    # Log-spaced buckets as in DDSketch: any value in a bucket is within
+    # `accuracy` (relative) of the bucket's midpoint, and two sketches merge by
+    # adding their bucket counts, so results combine across files, worker
+    # processes and runs without keeping the values themselves.
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can't merge sketches with a different accuracy")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self._gamma**index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "buckets": sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_json(cls, data, accuracy=0.01):
+        sketch = cls(accuracy)
+        sketch.buckets = {index: count for index, count in data["buckets"]}
+        sketch.count = data["count"]
+        sketch.total = data["sum"]
+        sketch.min = data["min"]
+        sketch.max = data["max"]
+        return sketch
+
+
+PRICE_SUMMARY_KEY = ("district_code", "property_locality", "month", "zone_code")
+
+
+class PriceSummary:
+    # purchase_price / area of the sales with an area in square meters, as a
+    # sketch per district, locality, settlement month and zone. Coarser views
+    # (e.g. per district and month) are rolled up by merging sketches.
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.groups = {}
+
+    def add_rows(self, rows):
+        district_code = COLUMNS.index("district_code")
+        locality = COLUMNS.index("property_locality")
+        zone_code = COLUMNS.index("zone_code")
+        area = COLUMNS.index("area")
+        area_type = COLUMNS.index("area_type")
+        purchase_price = COLUMNS.index("purchase_price")
+        settlement_date = COLUMNS.index("settlement_date")
+        for row in rows:
+            if row[area_type] != "Square Meters":
+                continue
+            try:
+                price_per_m2 = float(row[purchase_price]) / float(row[area])
+            except (ValueError, ZeroDivisionError):
+                continue
+            settled = row[settlement_date].strip()
+            if price_per_m2 <= 0 or not settled[:6].isdigit():
+                continue
+            key = (
+                row[district_code].strip(),
+                row[locality].strip(),
+                f"{settled[:4]}-{settled[4:6]}",
+                row[zone_code].strip(),
+            )
+            sketch = self.groups.get(key)
+            if sketch is None:
+                sketch = self.groups[key] = QuantileSketch(self.accuracy)
+            sketch.add(price_per_m2)
+
+    def merge(self, other):
+        for key, sketch in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(sketch)
+            else:
+                self.groups[key] = sketch
+
+    def rollup(self, by=("district_code", "month"), zones=None):
+        positions = [PRICE_SUMMARY_KEY.index(column) for column in by]
+        zone_code = PRICE_SUMMARY_KEY.index("zone_code")
+        groups = {}
+        for key, sketch in self.groups.items():
+            if zones is not None and key[zone_code] not in zones:
+                continue
+            rolled = tuple(key[position] for position in positions)
+            if rolled not in groups:
+                groups[rolled] = QuantileSketch(self.accuracy)
+            groups[rolled].merge(sketch)
+        return groups
+
+    def table(self, by=("district_code", "month"), zones=None,
+              quantiles=(0.1, 0.5, 0.9)):
+        for key, sketch in sorted(self.rollup(by, zones).items()):
+            row = dict(zip(by, key))
+            if "district_code" in row:
+                row["district_name"] = CODE_TO_DISTRICT.get(row["district_code"], "")
+            row["count"] = sketch.count
+            row["mean"] = sketch.total / sketch.count
+            for q in quantiles:
+                row[f"p{round(q * 100)}"] = sketch.quantile(q)
+            yield row
+
+    def save(self, path):
+        groups = [
+            dict(zip(PRICE_SUMMARY_KEY, key), **sketch.to_json())
+            for key, sketch in sorted(self.groups.items())
+        ]
+        with open(path, "w") as f:
+            json.dump({"accuracy": self.accuracy, "groups": groups}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        summary = cls(data["accuracy"])
+        for group in data["groups"]:
+            key = tuple(group[column] for column in PRICE_SUMMARY_KEY)
+            summary.groups[key] = QuantileSketch.from_json(group, summary.accuracy)
+        return summary
+
+
+def write_sources(sources, output, tracker, stream=False, workers=None, seen=None,
+                  summary=None, cache=None, filters=None, on_file=None):
+    if output.dedups:
+        seen = None
+    elif seen is None:
+        seen = DedupIndex()
+    for path, size, rows, seconds in iter_parsed(sources, workers, cache, filters):
+        METRICS.add_time("parse", seconds)
+        METRICS.record_file("parse", path, size, len(rows), seconds)
+        start = time.perf_counter()
+        if seen is None:
+            new_rows = rows
+        else:
+            new_rows = [row for row in rows if seen.add(row)]
+            METRICS.count("duplicates", len(rows) - len(new_rows))
+            METRICS.count("rows_written", len(new_rows))
+        deduped = time.perf_counter()
+        output.write_rows(new_rows)
+        written = time.perf_counter()
+        if summary is not None:
+            summary.add_rows(new_rows)
+            METRICS.add_time("aggregate", time.perf_counter() - written)
+        METRICS.add_time("dedup", deduped - start)
+        METRICS.add_time("write", written - deduped)
+        if stream:
+            MANIFEST.append(path)
+        if on_file is not None:
+            on_file(path, len(new_rows))
+        tracker(size)
+    return seen
+
+
+def load_parsed(parsed_path):
+    if not os.path.exists(parsed_path):
+        return {}
+    with open(parsed_path) as f:
+        return json.load(f)
+
+
+def skip_filtered(sources, keep, tracker):
+    for path, size, file in sources:
+        if not keep(path):
+            METRICS.count("skipped_files")
+            tracker(size)
+            continue
+        yield path, size, file
+
+
+def skip_parsed(sources, parsed, tracker):
+    # Data files are identified by content, extracted names carry the
+    # archives they came from and the same week can ship in several of them.
+    for path, size, file in sources:
+        data = Path(path).read_bytes() if file is None else file.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if digest in parsed:
+            METRICS.count("skipped_files")
+            tracker(size)
+            continue
+        parsed[digest] = Path(path).name
+        yield path, size, io.BytesIO(data)
+
+
+def check_output_options(output_format="csv", partition=False, append=False,
+                         price_summary=None, index=False, compression=None,
+                         districts=None, since=None, until=None, columns=None,
+                         shard=None, sort_by=None, address_index=False):
+    # The option combinations convert_sources can't write. main checks them
+    # before downloading anything, convert_sources again for library callers.
+    if partition and output_format != "csv":
+        raise ValueError("Partitioned output is only supported for CSV")
+    if index:
+        if output_format != "csv" or partition:
+            raise ValueError("The row index is only supported for a single CSV output")
+    if append:
+        if output_format != "csv" or partition:
+            raise ValueError("Appending is only supported for a single CSV output")
+        if districts is not None or since is not None or until is not None:
+            # The dedup keys and parsed files would stand for the whole
+            # dataset while the CSV only held some of it.
+            raise ValueError("Appending is only supported without filters")
+    if compression is not None:
+        if output_format != "csv" or partition or append or index:
+            raise ValueError(
+                "Compression is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+    if columns is not None:
+        if output_format != "csv" or partition or append or index:
+            raise ValueError(
+                "Column selection is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+        if compression is not None:
+            raise ValueError("Column selection is not supported with compression")
+    if sort_by is not None:
+        if output_format != "csv" or partition or append or index:
+            raise ValueError(
+                "Sorting is only supported for a single CSV output, "
+                "without --append or --index"
+            )
+        if compression is not None:
+            raise ValueError("Sorting is not supported with compression")
+        if shard is not None or price_summary is not None:
+            raise ValueError("Sorting is not supported with --shard or --price_summary")
+    if address_index:
+        if output_format != "csv" or partition or compression or columns:
+            raise ValueError(
+                "The address index is only supported for a single CSV output "
+                "with all columns"
+            )
+        if shard is not None:
+            raise ValueError("Build the address index on the merged output")
+
+
+def convert_sources(sources, out_path, tracker, stream=False, workers=None,
+                    output_format="csv", partition=False, append=False,
+                    price_summary=None, index=False, compression=None,
+                    parse_cache=None, parse_cache_size=1 << 30, districts=None,
+                    since=None, until=None, columns=None, shard=None, sort_by=None,
+                    sort_memory=512 << 20, address_index=False):
+    seen = keys_path = summary = row_index = cache = filters = on_file = None
+    check_output_options(
+        output_format, partition, append, price_summary, index, compression,
+        districts, since, until, columns, shard, sort_by, address_index
+    )
+    if shard is not None:
+        if output_format != "csv" or partition or append or index:
+            raise ValueError("Sharding is only supported for a single CSV output")
+        if compression is not None or columns is not None or price_summary:
+            raise ValueError(
+                "Sharding is not supported with compression, column selection "
+                "or a price summary, they apply to the merged output"
+            )
+        out_path = shard_path(out_path, *shard)
+        files = []
+        on_file = _shard_file_recorder(files, stream)
+    if append:
+        # The dedup keys and the data files already parsed are kept next to
+        # the output, so a rerun only parses and appends what is new.
+        keys_path, parsed_path = Path(f"{out_path}.keys"), Path(f"{out_path}.parsed")
+        parsed = {}
+        if os.path.exists(out_path):
+            seen = DedupIndex.load(keys_path) if keys_path.exists() else None
+            if seen is None:
+                seen = DedupIndex()
+                with open(out_path, newline="") as f:
+                    for row in itertools.islice(csv.reader(f), 1, None):
+                        seen.add(tuple(row))
+            parsed = load_parsed(parsed_path)
+        else:
+            append = False
+        sources = skip_parsed(sources, parsed, tracker)
+    if price_summary is not None:
+        # Appended runs only see the new sales, so they add to the summary of
+        # the sales already in the output.
+        if append and os.path.exists(price_summary):
+            summary = PriceSummary.load(price_summary)
+        else:
+            summary = PriceSummary()
+            if append:
+                with open(out_path, newline="") as f:
+                    summary.add_rows(itertools.islice(csv.reader(f), 1, None))
+    if index:
+        index_path = Path(f"{out_path}.idx")
+        row_index = RowIndexWriter(index_path, merge_existing=append)
+        if append and not index_path.exists():
+            index_existing_rows(row_index, out_path)
+    if parse_cache is not None:
+        cache = ParseCache(parse_cache, parse_cache_size)
+    if districts is not None or since is not None or until is not None:
+        filters = {"districts": districts, "since": since, "until": until}
+        keep = name_filter(districts, since)
+        if keep is not None:
+            sources = skip_filtered(sources, keep, tracker)
+    append_from = os.path.getsize(out_path) if append else None
+    try:
+        with open_output(
+            out_path,
+            output_format,
+            partition,
+            append,
+            None if row_index is None else row_index.add_rows,
+            compression,
+            columns,
+            sort_by,
+            sort_memory,
+        ) as output:
+            seen = write_sources(
+                sources, output, tracker, stream, workers, seen, summary, cache,
+                filters, on_file
+            )
+    except BaseException:
+        if row_index is not None:
+            row_index.discard()
+        if append_from is not None:
+            # Drop the partially appended rows, nothing was recorded for them.
+            os.truncate(out_path, append_from)
+        raise
+    if row_index is not None:
+        with METRICS.stage("index"):
+            row_index.close()
+        MANIFEST.append(index_path)
+    if address_index:
+        # Built from the finished CSV, so appended runs index all of it.
+        with METRICS.stage("address_index"):
+            MANIFEST.append(build_address_index(out_path))
+    if summary is not None:
+        summary.save(price_summary)
+        MANIFEST.append(price_summary)
+    if compression is not None:
+        MANIFEST.append(f"{out_path}.blocks.json")
+    if keys_path is not None:
+        seen.save(keys_path)
+        with open(parsed_path, "w") as f:
+            json.dump(parsed, f, indent=1, sort_keys=True)
+    if shard is not None:
+        write_shard_description(out_path, shard, stream, files)
+    MANIFEST.append(out_path)
+    return seen
+
+
+def shard_path(out_path, shard, shards):
+    return Path(f"{out_path}.shard-{shard}-of-{shards}")
+
+
+def _shard_file_recorder(files, stream):
+    # The merge puts files back in the order a single run reads them: by
+    # name from the extracted directory, or archive by archive (in name
+    # order) and member by member when streaming. Whole archives go to one
+    # shard, so counting members within each archive is enough.
+    members = {}
+
+    def on_file(path, rows):
+        name = str(path) if stream else Path(path).name
+        if stream:
+            archive = name.split("/", 1)[0]
+            members[archive] = members.get(archive, -1) + 1
+            order = [archive, members[archive]]
+        else:
+            order = [name]
+        files.append({"name": name, "order": order, "rows": rows})
+
+    return on_file
+
+
+def write_shard_description(partial_path, shard, stream, files):
+    # Rows in the partial CSV are grouped by file in the order listed here,
+    # already deduplicated within the shard. A row dropped that way also
+    # has an earlier copy in the same shard, so the merge still sees the
+    # first copy of every sale.
+    description = {
+        "shard": shard[0],
+        "shards": shard[1],
+        "mode": "stream" if stream else "files",
+        "columns": COLUMNS,
+        "csv": Path(partial_path).name,
+        "rows": sum(file["rows"] for file in files),
+        "files": files,
+    }
+    description_path = Path(f"{partial_path}.json")
+    with open(description_path, "w") as f:
+        json.dump(description, f, indent=1)
+    MANIFEST.append(description_path)
+
+
+def load_shard_descriptions(out_path):
+    out_path = Path(out_path)
+    descriptions = []
+    for path in sorted(out_path.parent.glob(f"{out_path.name}.shard-*-of-*.json")):
+        with open(path) as f:
+            description = json.load(f)
+        description["path"] = path.parent / description["csv"]
+        descriptions.append(description)
+    if not descriptions:
+        raise ValueError(f"No shards of {out_path} found")
+    shards = {description["shards"] for description in descriptions}
+    modes = {description["mode"] for description in descriptions}
+    if len(shards) != 1 or len(modes) != 1:
+        raise ValueError(f"Shards of {out_path} come from different runs")
+    found = sorted(description["shard"] for description in descriptions)
+    if found != list(range(shards.pop())):
+        raise ValueError(f"Shards of {out_path} are missing, found {found}")
+    for description in descriptions:
+        if tuple(description["columns"]) != COLUMNS:
+            raise ValueError(f"{description['path']} has different columns")
+    return descriptions
+
+
+def merge_shards(out_path):
+    # Replays the shards' files in the order a single run reads them, with
+    # the same global dedup, so the result is byte for byte what a single
+    # run writes.
+    descriptions = load_shard_descriptions(out_path)
+    files = sorted(
+        (file["order"], description["shard"], file["rows"])
+        for description in descriptions
+        for file in description["files"]
+    )
+    seen = DedupIndex()
+    with contextlib.ExitStack() as stack:
+        readers = {}
+        for description in descriptions:
+            f = stack.enter_context(open(description["path"], newline=""))
+            readers[description["shard"]] = reader = csv.reader(f)
+            if tuple(next(reader, ())) != COLUMNS:
+                raise ValueError(f"{description['path']} has no CSV header")
+        output = stack.enter_context(CsvOutput(out_path))
+        for _, shard, count in files:
+            rows = [tuple(row) for row in itertools.islice(readers[shard], count)]
+            if len(rows) != count:
+                raise ValueError(f"Shard {shard} of {out_path} is truncated")
+            new_rows = [row for row in rows if seen.add(row)]
+            output.write_rows(new_rows)
+            METRICS.count("duplicates", count - len(new_rows))
+            METRICS.count("rows_written", len(new_rows))
+    MANIFEST.append(out_path)
+    return seen
+
+
+def data_to_csv(base, out_path, stream=False, workers=None, **options):
+    if stream:
+        keep = name_filter(options.get("districts"), options.get("since"))
+        shard = options.get("shard")
+        select = None if shard is None else shard_filter(*shard)
+        sources = stream_dat_files(base, keep, select)
+        tracker = progress_tracker(None, "Parsing")
+    else:
+        paths = sorted(Path(base).glob("*.DAT"), key=lambda path: path.name)
+        sources = ((path, path.stat().st_size, None) for path in paths)
+        tracker = progress_tracker(len(paths), "Parsing")
+    with METRICS.stage("convert"):
+        seen = convert_sources(sources, out_path, tracker, stream, workers, **options)
+    if stream:
+        tracker.flush()
+        print(flush=True)
+    if seen is not None:
+        print(f"Output holds {len(seen)} unique sales (dedup index {seen.nbytes / 2**20:.1f}MiB).")
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _drain(q, stop):
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is None:
+            return
+        yield item
+
+
+def _queue_archive(archives, stop):
+    def on_download(file_path):
+        if not _put(archives, Path(file_path), stop):
+            raise RuntimeError("Pipeline stopped")
+
+    return on_download
+
+
+def run_pipeline(download_path, pdf_path, out_path, url=BASE_URL, state=None,
+                 workers=None, max_connections=8, queue_size=8, **options):
+    # Downloads, extraction and parsing run concurrently, connected by bounded
+    # queues so a slow stage holds back the ones feeding it.
+    archives = queue.Queue(maxsize=queue_size)
+    dat_files = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    keep = name_filter(options.get("districts"), options.get("since"))
+
+    def download():
+        try:
+            fetch_data(
+                download_path,
+                pdf_path,
+                url,
+                state,
+                _queue_archive(archives, stop),
+                max_connections,
+                keep,
+            )
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(archives, None, stop)
+
+    def extract():
+        try:
+            with METRICS.stage("extract"):
+                for archive in _drain(archives, stop):
+                    for name, size, member in iter_zip_dat_files(
+                        archive, archive.name + "/", keep
+                    ):
+                        METRICS.record_file("extract", name, size)
+                        item = (name, size, io.BytesIO(member.read()))
+                        _put(dat_files, item, stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(dat_files, None, stop)
+
+    threads = [
+        threading.Thread(target=download, daemon=True),
+        threading.Thread(target=extract, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        with METRICS.stage("convert"):
+            seen = convert_sources(
+                _drain(dat_files, stop),
+                out_path,
+                lambda _bytes: None,
+                True,
+                workers,
+                **options,
+            )
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    if seen is not None:
+        print(f"Output holds {len(seen)} unique sales (dedup index {seen.nbytes / 2**20:.1f}MiB).")
+
+
+def write_manifest(manifest_path, when):
+    MANIFEST.append(manifest_path)
+    with open(manifest_path, "w") as f:
+        f.write(f"NSW Land Data Manifest (as of {when})\n\n")
+        for line in MANIFEST:
+            f.write(str(line) + "\n")
+
+
+def query_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="nsw_property_sales.py query",
+        description="Print the sales in a database written with "
+        "--output_format sqlite that match all the given filters, as CSV.",
+    )
+    parser.add_argument("db_path", type=Path, help="Path to the SQLite database")
+    parser.add_argument("--property_id", default=None)
+    parser.add_argument("--locality", default=None, help="Suburb, e.g. NEWTOWN")
+    parser.add_argument("--street", default=None, help="Street name, e.g. 'SMITH ST'")
+    parser.add_argument("--house_number", default=None)
+    parser.add_argument(
+        "--district",
+        action="append",
+        default=None,
+        help="District code, can be given more than once",
+    )
+    parser.add_argument("--since", default=None, help="Earliest settlement date")
+    parser.add_argument("--until", default=None, help="Latest settlement date")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args(argv)
+    if not args.db_path.exists():
+        parser.error(f"{args.db_path} does not exist")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(COLUMNS)
+    writer.writerows(
+        query_sales(
+            args.db_path,
+            args.property_id,
+            args.locality,
+            args.street,
+            args.house_number,
+            args.district,
+            args.since,
+            args.until,
+            args.limit,
+        )
+    )
+
+
+def lookup_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="nsw_property_sales.py lookup",
+        description="Print every sale of a property from a CSV written with "
+        "--index, using the index to read only the matching rows.",
+    )
+    parser.add_argument("csv_path", type=Path, help="Path to the CSV")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--property_id", default=None)
+    group.add_argument(
+        "--address", default=None, help="e.g. '1/165 SMITH ST, NEWTOWN'"
+    )
+    args = parser.parse_args(argv)
+    if not Path(f"{args.csv_path}.idx").exists():
+        parser.error(f"{args.csv_path}.idx does not exist, convert with --index")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(COLUMNS)
+    writer.writerows(lookup_sales(args.csv_path, args.property_id, args.address))
+
+
+def merge_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="nsw_property_sales.py merge",
+        description="Combine the partial CSVs written with --shard i/N into "
+        "csv_path, identical to what a single run writes.",
+    )
+    parser.add_argument(
+        "csv_path", type=Path, help="The --csv_path the shards were run with"
+    )
+    args = parser.parse_args(argv)
+    start = time.time()
+    try:
+        seen = merge_shards(args.csv_path)
+    except ValueError as e:
+        parser.error(str(e))
+    print(
+        f"Merged {len(seen)} unique sales into '{args.csv_path}'. "
+        f"(in {time.time() - start:.2f}s)"
+    )
+
+
+def parse_shard(value):
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if match is None or not int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"expected i/N with 0 <= i < N, got {value}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def search_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="nsw_property_sales.py search",
+        description="Print the sales whose address holds every word of the "
+        "query, from a CSV written with --address_index. The last word can be "
+        "partly typed and words with one typo are still found.",
+    )
+    parser.add_argument("csv_path", type=Path, help="Path to the CSV")
+    parser.add_argument("query", help="e.g. '12 SMITH ST PADD'")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="(Re)build csv_path.adr from the CSV first",
+    )
+    args = parser.parse_args(argv)
+    if args.build:
+        build_address_index(args.csv_path)
+    elif not Path(f"{args.csv_path}.adr").exists():
+        parser.error(f"{args.csv_path}.adr does not exist, convert with --address_index")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(COLUMNS)
+    writer.writerows(search_addresses(args.csv_path, args.query, args.limit))
+
+
+COMMANDS = {
+    "query": query_main,
+    "lookup": lookup_main,
+    "merge": merge_main,
+    "search": search_main,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    start = time.time()
+    parser = argparse.ArgumentParser(description="Process some integers.")
+    parser.add_argument(
+        "--download_path",
+        type=Path,
+        default="./downloads",
+        help="Path where downloads will be stored",
+    )
+    parser.add_argument(
+        "--data_path",
+        type=Path,
+        default="./extracted",
+        help="Path where extracted data will be stored",
+    )
+    parser.add_argument(
+        "--csv_path",
+        type=Path,
+        default="./land_value.csv",
+        help="Path to output file",
+    )
+    parser.add_argument(
+        "--pdf_path", type=Path, default="./pdfs", help="Path to PDF files"
+    )
+    parser.add_argument(
+        "--manifest_file",
+        type=Path,
+        default="./manifest.txt",
+        help="A manifest of all files donwloaded, and parsed.",
+    )
+    parser.add_argument(
+        "--keep_raw_files",
+        action="store_true",
+        default=False,
+        help="Keep the raw data directories",
+    )
+    parser.add_argument(
+        "--incremental_download",
+        action="store_true",
+        default=False,
+        help="Keep downloaded archives between runs and only fetch the ones "
+        "that changed on the server (implies keeping the download directory)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Parse the data files straight out of the downloaded (nested) "
+        "zips instead of extracting them to disk first",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="Extract and parse each archive as soon as its download finishes "
+        "(implies --stream)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Parse data files in this many worker processes, and extract "
+        "archives in this many threads. Without it parsing is serial, in "
+        "this process, and only extraction uses all cores",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=("csv", "parquet", "sqlite"),
+        default="csv",
+        help="Format of the output file (parquet requires pyarrow, sqlite "
+        "writes an indexed database that the query command can search)",
+    )
+    parser.add_argument(
+        "--partition",
+        action="store_true",
+        default=False,
+        help="Write one CSV per district and settlement year under "
+        "csv_path/district_code=XXX/year=YYYY/, with a _partitions.json manifest",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        default=False,
+        help="Add only sales from data files not seen before to an existing "
+        "CSV instead of rebuilding it",
+    )
+    parser.add_argument(
+        "--price_summary",
+        type=Path,
+        default=None,
+        help="Also write price per square meter quantile sketches per district, "
+        "locality, settlement month and zone to this JSON file",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        default=False,
+        help="Write a csv_path.idx index of the byte offset of every sale by "
+        "property_id and address, for the lookup command",
+    )
+    parser.add_argument(
+        "--districts",
+        action="append",
+        default=None,
+        help="Only keep sales in this district code, can be given more than once. "
+        "Weekly data files of other districts aren't read",
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        help="Only keep sales with a contract on or after this date (YYYY-MM-DD). "
+        "Archives that end before it aren't downloaded or read",
+    )
+    parser.add_argument(
+        "--until",
+        default=None,
+        help="Only keep sales with a contract on or before this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--columns",
+        default=None,
+        help="Comma separated columns to write, all of them by default",
+    )
+    parser.add_argument(
+        "--address_index",
+        action="store_true",
+        help="Also write csv_path.adr, an index of address words for the "
+        "search command",
+    )
+    parser.add_argument(
+        "--sort_by",
+        default=None,
+        help="Comma separated columns to sort the CSV by (as text), e.g. "
+        "district_code,property_locality,property_street_name,property_house_number. "
+        "Sorted with an external merge sort that also drops the duplicates",
+    )
+    parser.add_argument(
+        "--sort_memory",
+        type=int,
+        default=512,
+        help="Memory for sorting in MiB, beyond it sorted runs are spilled to "
+        "temporary files next to the CSV",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only download and convert shard i of N (e.g. 0/4) of the "
+        "archives, writing csv_path.shard-i-of-N for the merge command",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=("gzip", "xz"),
+        default=None,
+        help="Write the CSV as independently compressed blocks (still readable "
+        "with zcat/xzcat), with a csv_path.blocks.json index for random access",
+    )
+    parser.add_argument(
+        "--parse_cache",
+        type=Path,
+        default=None,
+        help="Cache the parsed rows of each data file in this directory, "
+        "keyed by the file's contents, so unchanged files aren't parsed again",
+    )
+    parser.add_argument(
+        "--parse_cache_size",
+        type=int,
+        default=1024,
+        help="Size limit of the parse cache in MiB, least recently used "
+        "entries are evicted beyond it",
+    )
+    parser.add_argument(
+        "--max_connections",
+        type=int,
+        default=8,
+        help="Upper limit on concurrent downloads, the actual number adapts "
+        "to how the server responds",
+    )
+    parser.add_argument(
+        "--base_url",
+        default=BASE_URL,
+        help="Page listing the sales archives to download",
+    )
+    parser.add_argument(
+        "--metrics_json",
+        type=Path,
+        default=None,
+        help="Write per-stage timings, per-file statistics and throughput "
+        "counters to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=None,
+        help="Write a cProfile dump and a tracemalloc report for each stage "
+        "to this directory",
+    )
+
+    args = parser.parse_args(argv)
+    for name in ("since", "until"):
+        value = getattr(args, name)
+        if value is not None and not re.fullmatch(r"\d{8}", _as_yyyymmdd(value)):
+            parser.error(f"--{name} must be a date, YYYY-MM-DD")
+    for name in ("columns", "sort_by"):
+        value = getattr(args, name)
+        if value is not None:
+            value = tuple(column.strip() for column in value.split(","))
+            unknown = [column for column in value if column not in COLUMNS]
+            if unknown:
+                parser.error(f"Unknown columns in --{name}: {', '.join(unknown)}")
+            setattr(args, name, value)
+    if args.shard is not None and args.pipeline:
+        parser.error("--shard is not supported with --pipeline")
+    if args.max_connections < 1:
+        parser.error("--max_connections must be at least 1")
+    try:
+        check_output_options(
+            output_format=args.output_format,
+            partition=args.partition,
+            append=args.append,
+            price_summary=args.price_summary,
+            index=args.index,
+            compression=args.compress,
+            districts=args.districts,
+            since=args.since,
+            until=args.until,
+            columns=args.columns,
+            shard=args.shard,
+            sort_by=args.sort_by,
+            address_index=args.address_index,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    keep = name_filter(args.districts, args.since)
+    select = None
+    if args.shard is not None:
+        select = shard_filter(*args.shard)
+        # Shards can share --download_path and --data_path, each one works
+        # in (and removes) its own subdirectory of them.
+        subdirectory = "shard-{}-of-{}".format(*args.shard)
+        args.download_path = args.download_path / subdirectory
+        args.data_path = args.data_path / subdirectory
+    args.download_path.mkdir(parents=True, exist_ok=True)
+    args.csv_path.parent.mkdir(parents=True, exist_ok=True)
+    args.data_path.mkdir(parents=True, exist_ok=True)
+    args.pdf_path.mkdir(parents=True, exist_ok=True)
+    METRICS.reset()
+    if args.profile is not None:
+        args.profile.mkdir(parents=True, exist_ok=True)
+        METRICS.profile_path = args.profile
+        tracemalloc.start()
+
+    try:
+        when = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"NSW Bulk property sales information downloader. (as of {when})")
         print(f"Fetching sales data (to '{args.download_path}').")
-        fetch_data(args.download_path, args.pdf_path)
-        print(f"Extracting data files. (to '{args.data_path}')")
-        process_downloaded_files(args.download_path, args.data_path)
-        print(f"Converting to CSV. (to '{args.csv_path}')")
-        data_to_csv(args.data_path, args.csv_path)
+        state = None
+        if args.incremental_download:
+            state_path = args.download_path / "download_state.json"
+            state = load_download_state(state_path)
+        try:
+            if args.pipeline:
+                print(f"Converting to CSV. (to '{args.csv_path}')")
+                run_pipeline(
+                    args.download_path,
+                    args.pdf_path,
+                    args.csv_path,
+                    args.base_url,
+                    state,
+                    args.workers,
+                    args.max_connections,
+                    output_format=args.output_format,
+                    partition=args.partition,
+                    append=args.append,
+                    price_summary=args.price_summary,
+                    index=args.index,
+                    compression=args.compress,
+                    parse_cache=args.parse_cache,
+                    parse_cache_size=args.parse_cache_size << 20,
+                    districts=args.districts,
+                    since=args.since,
+                    until=args.until,
+                    columns=args.columns,
+                    shard=args.shard,
+                    sort_by=args.sort_by,
+                    sort_memory=args.sort_memory << 20,
+                    address_index=args.address_index,
+                )
+            else:
+                fetch_data(
+                    args.download_path,
+                    args.pdf_path,
+                    args.base_url,
+                    state,
+                    max_connections=args.max_connections,
+                    keep=keep,
+                    select=select,
+                    # Shards share the PDF directory, one copy is enough.
+                    pdfs=args.shard is None or args.shard[0] == 0,
+                )
+        finally:
+            if state is not None:
+                save_download_state(state_path, state)
+        if args.stream and not args.pipeline:
+            print(f"Converting to CSV. (to '{args.csv_path}')")
+            data_to_csv(
+                args.download_path,
+                args.csv_path,
+                stream=True,
+                workers=args.workers,
+                output_format=args.output_format,
+                partition=args.partition,
+                append=args.append,
+                price_summary=args.price_summary,
+                index=args.index,
+                compression=args.compress,
+                parse_cache=args.parse_cache,
+                parse_cache_size=args.parse_cache_size << 20,
+                districts=args.districts,
+                since=args.since,
+                until=args.until,
+                columns=args.columns,
+                shard=args.shard,
+                sort_by=args.sort_by,
+                sort_memory=args.sort_memory << 20,
+                address_index=args.address_index,
+            )
+        elif not args.pipeline:
+            print(f"Extracting data files. (to '{args.data_path}')")
+            if args.incremental_download:
+                process_downloaded_files(
+                    args.data_path / "archives",
+                    args.data_path,
+                    args.download_path,
+                    args.workers,
+                    keep,
+                    select,
+                )
+            else:
+                process_downloaded_files(
+                    args.download_path,
+                    args.data_path,
+                    workers=args.workers,
+                    keep=keep,
+                    select=select,
+                )
+            print(f"Converting to CSV. (to '{args.csv_path}')")
+            data_to_csv(
+                args.data_path,
+                args.csv_path,
+                workers=args.workers,
+                output_format=args.output_format,
+                partition=args.partition,
+                append=args.append,
+                price_summary=args.price_summary,
+                index=args.index,
+                compression=args.compress,
+                parse_cache=args.parse_cache,
+                parse_cache_size=args.parse_cache_size << 20,
+                districts=args.districts,
+                since=args.since,
+                until=args.until,
+                columns=args.columns,
+                shard=args.shard,
+                sort_by=args.sort_by,
+                sort_memory=args.sort_memory << 20,
+                address_index=args.address_index,
+            )
         print(f"Writing manifest. (to '{args.manifest_file}')")
         write_manifest(args.manifest_file, when)
     finally:
         if not args.keep_raw_files:
-            print(f"Removing raw files. ('{args.download_path}', '{args.data_path}')")
-            assert len(args.download_path) > 5, "download_path short, not deleting"
-            assert len(args.data_path) > 5, "data_path short, not deleting"
-            shutil.rmtree(args.download_path)
-            shutil.rmtree(args.data_path)
+            raw_paths = [args.data_path]
+            if not args.incremental_download:
+                raw_paths.insert(0, args.download_path)
+            print(f"Removing raw files. {tuple(str(p) for p in raw_paths)}")
+            for raw_path in raw_paths:
+                assert len(str(raw_path)) > 5, f"{raw_path} short, not deleting"
+                shutil.rmtree(raw_path)
+        if args.profile is not None:
+            tracemalloc.stop()
+            METRICS.profile_path = None
+        if args.metrics_json is not None:
+            METRICS.add_time("total", time.time() - start)
+            METRICS.write_json(args.metrics_json)
     duration = time.time() - start
     print(f"Done. (in {duration:.2f}s)")
 